@@ -0,0 +1,6 @@
+""" Benchmarks for MVW.
+
+Run with `python -m mvw.benchmark` to build a synthetic wiki in a
+temporary directory and print timings of generating and serving it
+as JSON. See `python -m mvw.benchmark --help` for the shape of
+the wiki and other options. """
@@ -0,0 +1,79 @@
+""" Runs the MVW benchmarks and writes the results as JSON """
+
+import json
+import shutil
+import sys
+import tempfile
+from optparse import OptionParser
+
+from mvw.benchmark import bench, wiki
+
+
+def run():
+    usage = "%prog [options]"
+    opts = OptionParser(usage=usage, description=__doc__)
+    opts.add_option("--depth", type="int", default=2,
+            help="levels of subdirectories (default: %default)")
+    opts.add_option("--fanout", type="int", default=3,
+            help="subdirectories per directory (default: %default)")
+    opts.add_option("--files", type="int", default=20,
+            help="files per directory (default: %default)")
+    opts.add_option("--mix", default="0.7,0.2,0.1",
+            help="proportions of markdown, code and binary files "
+                 "(default: %default)")
+    opts.add_option("--size", type="int", default=4096,
+            help="median file size in bytes (default: %default)")
+    opts.add_option("--sigma", type="float", default=1.0,
+            help="spread of the log-normal file size distribution "
+                 "(default: %default)")
+    opts.add_option("--max-size", type="int", default=4 * 1024 * 1024,
+            help="maximum file size in bytes (default: %default)")
+    opts.add_option("--seed", type="int", default=0,
+            help="random seed of the wiki (default: %default)")
+    opts.add_option("-j", "--jobs", type="int", default=None,
+            help="processes used to generate (default: number of CPUs)")
+    opts.add_option("--requests", type="int", default=1000,
+            help="requests sent to the server (default: %default)")
+    opts.add_option("--clients", type="int", default=8,
+            help="concurrent server clients (default: %default)")
+    opts.add_option("--no-serve", action="store_true", default=False,
+            help="skip the server benchmark")
+    opts.add_option("--dir", default=None,
+            help="build the wiki in this directory and keep it "
+                 "(default: a temporary directory)")
+    opts.add_option("-o", "--output", default=None,
+            help="write results to this file (default: stdout)")
+    (options, args) = opts.parse_args()
+    if args:
+        opts.print_usage()
+        sys.exit(-1)
+
+    mix = tuple(float(m) for m in options.mix.split(','))
+    if len(mix) != 3:
+        opts.error("--mix needs three proportions")
+
+    shape = wiki.Shape(depth=options.depth, fanout=options.fanout,
+                       files=options.files, mix=mix, size=options.size,
+                       sigma=options.sigma, max_size=options.max_size,
+                       seed=options.seed)
+
+    root = options.dir or tempfile.mkdtemp(prefix='mvw-bench-')
+    try:
+        results = bench.run(root, shape, jobs=options.jobs,
+                            requests=options.requests,
+                            clients=options.clients,
+                            serve=not options.no_serve)
+    finally:
+        if options.dir is None:
+            shutil.rmtree(root)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,193 @@
+""" Benchmarks of `mvw generate` and `mvw serve` on a synthetic wiki.
+Times cold, warm and incremental builds, regenerating pages per
+request and server throughput and latency. Results are returned
+as a dict that can be written as JSON and compared across releases. """
+
+import multiprocessing
+import os
+import platform
+import random
+import sys
+import threading
+import time
+try:
+    # Try python 3 packages
+    from http.client import HTTPConnection
+except ImportError:
+    # Try python 2 packages
+    from httplib import HTTPConnection
+
+from mvw import main
+from mvw.benchmark import wiki
+from mvw.generator import Generator
+from mvw.server import RequestHandler, Server
+
+
+class QuietRequestHandler(RequestHandler):
+    """ A RequestHandler that does not log requests """
+
+    def log_message(self, format, *args):
+        pass
+
+
+def timed(fn, *args, **kwargs):
+    """ Returns the seconds taken calling fn """
+    start = time.time()
+    fn(*args, **kwargs)
+    return time.time() - start
+
+
+def summary(latencies):
+    """ Summarizes latencies in seconds as milliseconds """
+    if not latencies:
+        return dict(count=0)
+
+    ordered = sorted(latencies)
+
+    def percentile(p):
+        return 1000 * ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+    return dict(count=len(ordered),
+                mean=1000 * sum(ordered) / len(ordered),
+                p50=percentile(0.5),
+                p95=percentile(0.95),
+                p99=percentile(0.99),
+                max=1000 * ordered[-1])
+
+
+def page_paths(root, created):
+    """ Returns the relative paths pages of created files are served at,
+    including the index of every directory """
+    relpaths = set()
+    for path in created['markdown'] + created['code']:
+        relpath = os.path.relpath(path, root)
+        base, _ = os.path.splitext(relpath)
+        relpaths.add('%s.html' % base.replace(os.path.sep, '/'))
+        reldir = os.path.dirname(relpath).replace(os.path.sep, '/')
+        relpaths.add('%s/' % reldir if reldir else '')
+    return sorted(relpaths)
+
+
+def create_generator(root):
+    """ Returns a generator of the wiki at root """
+    if main.get_root(root) is None:
+        main.init(root)
+    config = main.create_config(root)
+    config.serve_watch = False
+    return Generator(config)
+
+
+def bench_generate(root, created, jobs=None, changes=0.01):
+    """ Times generating the site from scratch (cold), without any
+    changes (warm) and after modifying a fraction of the pages
+    (incremental) """
+    generator = create_generator(root)
+    results = dict(cold=timed(generator.generate, True, jobs),
+                   warm=timed(generator.generate, False, jobs))
+
+    sources = created['markdown'] + created['code']
+    rnd = random.Random(0)
+    modified = rnd.sample(sources, max(1, int(len(sources) * changes)))
+    for path in modified:
+        with open(path, 'a') as f:
+            f.write('\n\nModified %f\n' % time.time())
+
+    results['incremental'] = timed(generator.generate, False, jobs)
+    results['modified'] = len(modified)
+    return results
+
+
+def bench_regenerate(root, relpaths, requests=200):
+    """ Times regenerating pages as requested by `mvw serve` """
+    generator = create_generator(root)
+    rnd = random.Random(0)
+    latencies = []
+    for _ in range(requests):
+        relpath = rnd.choice(relpaths)
+        latencies.append(timed(generator.regenerate, relpath))
+    return summary(latencies)
+
+
+def bench_serve(root, relpaths, requests=1000, clients=8):
+    """ Measures throughput and latency of `mvw serve` with clients
+    concurrently requesting random pages, one connection per request.
+    The first pass over all pages is measured separately as
+    those are not cached yet """
+
+    generator = create_generator(root)
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        server = Server(generator, '127.0.0.1', 0)
+    finally:
+        sys.stdout = stdout
+    server.RequestHandlerClass = QuietRequestHandler
+    port = server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    def fetch(paths, latencies):
+        for relpath in paths:
+            conn = HTTPConnection('127.0.0.1', port)
+            start = time.time()
+            conn.request('GET', '/%s' % relpath,
+                         headers={'Accept-Encoding': 'gzip'})
+            conn.getresponse().read()
+            latencies.append(time.time() - start)
+            conn.close()
+
+    def run(batches):
+        latencies = []
+        threads = [threading.Thread(target=fetch, args=(b, latencies))
+                   for b in batches]
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - start
+        result = summary(latencies)
+        result['seconds'] = elapsed
+        result['throughput'] = len(latencies) / elapsed if elapsed else 0
+        return result
+
+    try:
+        first = run([relpaths[i::clients] for i in range(clients)])
+        rnd = random.Random(0)
+        paths = [rnd.choice(relpaths) for _ in range(requests)]
+        cached = run([paths[i::clients] for i in range(clients)])
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    return dict(clients=clients, first=first, cached=cached,
+                cache=server.page_cache.stats())
+
+
+def run(root, shape, jobs=None, requests=1000, clients=8, serve=True):
+    """ Builds a synthetic wiki of shape at root and runs all
+    benchmarks. Returns the results """
+
+    start = time.time()
+    created = wiki.build(root, shape)
+    built = time.time() - start
+    relpaths = page_paths(root, created)
+
+    results = dict(
+        time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        cpus=multiprocessing.cpu_count(),
+        shape=shape.as_dict(),
+        files=dict((k, len(v)) for k, v in created.items()),
+        pages=len(relpaths),
+        bytes=sum(os.path.getsize(p) for v in created.values() for p in v),
+        build=built)
+
+    results['generate'] = bench_generate(root, created, jobs)
+    results['regenerate'] = bench_regenerate(root, relpaths,
+                                             min(requests, 200))
+    if serve:
+        results['serve'] = bench_serve(root, relpaths, requests, clients)
+    return results
@@ -0,0 +1,140 @@
+""" Synthetic wikis for benchmarks.
+Builds a tree of Markdown pages, source code and binary files
+of a given shape. Wikis are generated from a seed so the same
+shape and seed always produce the same files. """
+
+import binascii
+import math
+import os
+import random
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+         'eiusmod tempor incididunt ut labore et dolore magna aliqua enim '
+         'ad minim veniam quis nostrud exercitation ullamco laboris nisi '
+         'aliquip ex ea commodo consequat duis aute irure in reprehenderit '
+         'voluptate velit esse cillum fugiat nulla pariatur').split()
+
+CODE = '''def %(name)s(items, factor=%(factor)d):
+    """ Scales the items by factor """
+    result = []
+    for item in items:
+        if item %% 2 == 0:
+            result.append(item * factor)
+        else:
+            result.append("%%s-%%d" %% (item, factor))
+    return result
+
+'''
+
+
+class Shape:
+    """ Shape of a synthetic wiki.
+
+    `depth` levels of directories with `fanout` subdirectories each,
+    holding `files` files per directory. Files are Markdown pages,
+    Python sources or binary files in proportion to `mix` (markdown,
+    code, binary). File sizes are drawn from a log-normal distribution
+    with median `size` bytes and shape `sigma`, capped at `max_size`. """
+
+    def __init__(self, depth=2, fanout=3, files=20, mix=(0.7, 0.2, 0.1),
+                 size=4096, sigma=1.0, max_size=4 * 1024 * 1024, seed=0):
+        self.depth = depth
+        self.fanout = fanout
+        self.files = files
+        self.mix = mix
+        self.size = size
+        self.sigma = sigma
+        self.max_size = max_size
+        self.seed = seed
+
+    def as_dict(self):
+        """ Returns the shape as a JSON serializable dict """
+        return dict(depth=self.depth, fanout=self.fanout, files=self.files,
+                    mix=list(self.mix), size=self.size, sigma=self.sigma,
+                    max_size=self.max_size, seed=self.seed)
+
+
+def words(rnd, count):
+    """ Returns count random words """
+    return ' '.join(rnd.choice(WORDS) for _ in range(count))
+
+
+def markdown(rnd, size):
+    """ Returns Markdown text of about size characters with
+    meta data, headings, paragraphs, lists and code blocks """
+    parts = ['Title: %s\n\n' % words(rnd, 3).title()]
+    length = len(parts[0])
+    while length < size:
+        kind = rnd.random()
+        if kind < 0.15:
+            part = '## %s\n\n' % words(rnd, 4).title()
+        elif kind < 0.3:
+            part = ''.join('* %s\n' % words(rnd, 6)
+                           for _ in range(rnd.randint(2, 6))) + '\n'
+        elif kind < 0.4:
+            code = CODE % dict(name=rnd.choice(WORDS),
+                               factor=rnd.randint(2, 9))
+            part = '    :::python\n%s\n' % ''.join(
+                '    %s\n' % line for line in code.splitlines())
+        else:
+            part = '%s.\n\n' % words(rnd, rnd.randint(20, 80)).capitalize()
+        parts.append(part)
+        length += len(part)
+    return ''.join(parts)
+
+
+def code(rnd, size):
+    """ Returns Python source of about size characters """
+    parts = []
+    length = 0
+    while length < size:
+        part = CODE % dict(name='%s_%d' % (rnd.choice(WORDS), len(parts)),
+                           factor=rnd.randint(2, 9))
+        parts.append(part)
+        length += len(part)
+    return ''.join(parts)
+
+
+def binary(rnd, size):
+    """ Returns size random bytes """
+    return binascii.unhexlify('%0*x' % (2 * size, rnd.getrandbits(8 * size)))
+
+
+def build(root, shape):
+    """ Builds a synthetic wiki of shape at root.
+    Returns the paths of the files created by kind """
+
+    rnd = random.Random(shape.seed)
+    created = {'markdown': [], 'code': [], 'binary': []}
+    total = float(sum(shape.mix))
+    mu = math.log(shape.size)
+
+    def fill(directory, level):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        for i in range(shape.files):
+            size = min(int(rnd.lognormvariate(mu, shape.sigma)) + 1,
+                       shape.max_size)
+            pick = rnd.random() * total
+            if pick < shape.mix[0]:
+                kind, name = 'markdown', 'page_%d.md' % i
+                data = markdown(rnd, size).encode('utf-8')
+            elif pick < shape.mix[0] + shape.mix[1]:
+                kind, name = 'code', 'module_%d.py' % i
+                data = code(rnd, size).encode('utf-8')
+            else:
+                kind, name = 'binary', 'image_%d.png' % i
+                data = binary(rnd, size)
+
+            path = os.path.join(directory, name)
+            with open(path, 'wb') as f:
+                f.write(data)
+            created[kind].append(path)
+
+        if level < shape.depth:
+            for i in range(shape.fanout):
+                fill(os.path.join(directory, 'section_%d' % i), level + 1)
+
+    fill(root, 0)
+    return created
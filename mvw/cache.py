@@ -0,0 +1,215 @@
+""" Caches used by `mvw generate` and `mvw serve` """
+
+import codecs
+import os
+import threading
+from collections import OrderedDict
+
+from mvw.manifest import replace, temporary
+
+
+class LRUCache:
+    """ A thread safe least recently used cache bounded by the
+    total size in bytes of its values rather than entry count.
+
+    Values are validated by the caller on `get`; invalid values
+    are dropped. Valid values returned by `get` are counted as hits,
+    callers count misses with `miss` for lookups they had to
+    compute values for. """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, valid=None):
+        """ Returns the value cached for key or None.
+        If given, `valid(value)` must return True for the value
+        to be returned, otherwise it is removed from the cache. """
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        value, size = entry
+        if valid is not None and not valid(value):
+            self.discard(key)
+            return None
+
+        with self.lock:
+            if key in self.entries:
+                self.entries[key] = self.entries.pop(key)
+            self.hits += 1
+        return value
+
+    def peek(self, key):
+        """ Returns the value cached for key or None without
+        counting a hit or marking it as recently used """
+        with self.lock:
+            entry = self.entries.get(key)
+        return entry[0] if entry is not None else None
+
+    def keys(self):
+        """ Returns the cached keys from least to most recently used """
+        with self.lock:
+            return list(self.entries)
+
+    def put(self, key, value, size):
+        """ Caches value for key, evicting least recently used
+        values until the cache fits in its capacity. Values larger
+        than the capacity are not cached. """
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+
+            if size > self.capacity:
+                return
+
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.capacity:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= evicted
+
+    def miss(self):
+        """ Counts a lookup that missed the cache """
+        with self.lock:
+            self.misses += 1
+
+    def discard(self, key):
+        """ Removes key from the cache if present """
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+
+    def clear(self):
+        """ Removes all entries """
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def ratio(self):
+        """ Returns the ratio of hits to lookups """
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def stats(self):
+        """ Returns a summary of the cache for logging """
+        return '%d pages, %d/%d bytes, %.1f%% hits' % (
+            len(self.entries), self.size, self.capacity, 100 * self.ratio())
+
+
+class DiskCache:
+    """ A content addressed cache of text stored as files under
+    directory, bounded by the total size in bytes of its files.
+
+    Entries are files named by key, which should be a hash of
+    everything the value is computed from. Reading an entry marks
+    it as recently used by updating its modification time. The size
+    of the cache is scanned each time a tenth of its capacity was
+    written, by any process. When the cache grew larger than its
+    capacity, least recently used entries are removed until it is
+    back under 90% of its capacity. Entries are written atomically
+    so the cache can be shared by threads and worker processes. """
+
+    # Fraction of the capacity written between scans of the cache
+    scan_fraction = 0.1
+
+    def __init__(self, directory, capacity):
+        self.directory = directory
+        self.capacity = capacity
+        self.size = None
+        self.written = 0
+        self.lock = threading.Lock()
+
+    def path(self, key):
+        """ Returns the path of the file for key """
+        return os.path.join(self.directory, key[:2], key[2:])
+
+    def get(self, key):
+        """ Returns the text cached for key or None """
+        path = self.path(key)
+        try:
+            with codecs.open(path, encoding='utf-8') as f:
+                value = f.read()
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+        return value
+
+    def put(self, key, value):
+        """ Caches text value for key, evicting least recently used
+        entries if the cache is larger than its capacity. Values
+        larger than the capacity or that cannot be written
+        (read only or full disk) are not cached. """
+        data = value.encode('utf-8')
+        if len(data) > self.capacity:
+            return
+
+        path = self.path(key)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Created by another process
+                pass
+
+        tmp = temporary(path)
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            replace(tmp, path)
+        except (IOError, OSError):
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return
+
+        with self.lock:
+            self.written += len(data)
+            if self.written >= self.capacity * self.scan_fraction:
+                self.written = 0
+                self.evict()
+
+    def entries(self):
+        """ Returns (mtime, path, size) of every cached entry """
+        entries = []
+        for root, dirs, files in os.walk(self.directory):
+            for f in files:
+                if f.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, f)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, path, st.st_size))
+        return entries
+
+    def evict(self):
+        """ Scans the size of the cache. If it is larger than its
+        capacity, removes least recently used entries until it is
+        under 90% of its capacity """
+        entries = sorted(self.entries())
+        size = sum(e[2] for e in entries)
+        self.size = size
+        if size <= self.capacity:
+            return
+
+        target = self.capacity * 0.9
+        for _, path, entry_size in entries:
+            if size <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= entry_size
+        self.size = size
@@ -0,0 +1,132 @@
+""" Compression of text outputs for `mvw generate` and `mvw serve`.
+gzip is always available, brotli (`br`) is used if the brotli
+module is installed. Compressed output is deterministic so
+unchanged files compress to identical bytes. """
+
+import gzip
+import io
+import os
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from mvw.manifest import replace, temporary
+
+# File name suffix of precompressed siblings by encoding
+SUFFIXES = {'gzip': '.gz', 'br': '.br'}
+
+
+def encodings():
+    """ Returns the available encodings in order of preference """
+    if brotli is not None:
+        return ['br', 'gzip']
+    return ['gzip']
+
+
+def compress(data, encoding):
+    """ Compresses data with encoding """
+    if encoding == 'br':
+        return brotli.compress(data)
+
+    buf = io.BytesIO()
+    with gzip.GzipFile(filename='', mode='wb', fileobj=buf, mtime=0) as gz:
+        gz.write(data)
+    return buf.getvalue()
+
+
+class Compressor:
+    """ Compresses a stream of data with encoding.
+    Call `compress(data)` for each chunk of data and `flush()`
+    at the end, writing all returned data in order. """
+
+    def __init__(self, encoding):
+        if encoding == 'br':
+            compressor = brotli.Compressor()
+            self.compress = compressor.process
+            self.flush = compressor.finish
+        else:
+            # gzip container without a file name or mtime
+            compressor = zlib.compressobj(9, zlib.DEFLATED,
+                                          16 + zlib.MAX_WBITS)
+            self.compress = compressor.compress
+            self.flush = compressor.flush
+
+
+def compressible(path, size, config):
+    """ Returns True if a file at path of the given size should be
+    compressed according to `compress_types` and `compress_min_size` """
+    _, ext = os.path.splitext(path)
+    return ext in config.compress_types and size >= config.compress_min_size
+
+
+def negotiate(accept_encoding, available):
+    """ Returns the available encoding preferred by an Accept-Encoding
+    header or None if only the identity encoding is acceptable """
+    accepted = {}
+    for part in (accept_encoding or '').split(','):
+        params = part.split(';')
+        coding = params[0].strip().lower()
+        if not coding:
+            continue
+
+        q = 1.0
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+
+    best, bestq = None, 0.0
+    for encoding in available:
+        q = accepted.get(encoding, accepted.get('*', 0.0))
+        if q > bestq:
+            best, bestq = encoding, q
+    return best
+
+
+def precompress(path, config):
+    """ Writes compressed siblings of path (`path.gz`, `path.br`)
+    for each available encoding. Siblings are given the mtime of
+    path and are kept while it is unchanged. Siblings of files
+    that are not compressible are removed. """
+
+    st = os.stat(path)
+    keep = compressible(path, st.st_size, config)
+    data = None
+
+    for encoding in encodings():
+        sibling = path + SUFFIXES[encoding]
+        try:
+            current = os.path.getmtime(sibling) == st.st_mtime
+        except OSError:
+            current = None
+
+        if not keep:
+            if current is not None:
+                os.remove(sibling)
+            continue
+        elif current:
+            continue
+
+        if data is None:
+            with open(path, 'rb') as f:
+                data = f.read()
+
+        tmp = temporary(sibling)
+        with open(tmp, 'wb') as f:
+            f.write(compress(data, encoding))
+        os.utime(tmp, (st.st_atime, st.st_mtime))
+        replace(tmp, sibling)
+
+
+def remove_siblings(path):
+    """ Removes all compressed siblings of path """
+    for suffix in SUFFIXES.values():
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
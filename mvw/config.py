@@ -1,6 +1,17 @@
 import os
 import sys
 
+from mvw.profiler import describe, span
+
+try:
+    # python 2
+    string_types = basestring
+except NameError:
+    string_types = str
+
+# Placeholder for content rendered as chunks
+CONTENT_MARKER = '\x00mvw:content\x00'
+
 
 class Config:
     """ Holds configurable properties of MVW.
@@ -19,18 +30,125 @@ class Config:
         self.themes = {}
         self.breadcrumb_home = None
         self.port = 8000
+        self.serve_cache_size = 64 * 1024 * 1024
+        self.serve_workers = 8
+        self.serve_stream_size = 1024 * 1024
+        self.serve_watch = True
+        self.watch_debounce = 0.25
+        self.precompress = False
+        self.compress_min_size = 1024
+        self.compress_types = ['.html', '.css', '.js', '.svg',
+                               '.txt', '.xml', '.json']
+        self.publish = 'copy'
+        self.highlight_cache_size = 128 * 1024 * 1024
+        self.fragment_cache_size = 256 * 1024 * 1024
+        self.template_cache = True
+        self.large_file_size = 16 * 1024 * 1024
+        self.large_file_mode = 'preview'
+        self.large_file_preview_size = 256 * 1024
+        self.search = True
         self.converters = []
-
-    def converter(self, predicate, converter):
+        self.fragments = {}
+        self.publishers = {}
+        self._fragment_settings = None
+        self.profiler = None
+        self.converter_index = None
+        self.converter_cache = {}
+        self.page_cache = {}
+        self.breadcrumb_cache = {}
+        self.listing_cache = None
+
+    def converter(self, predicate, converter, extensions=None,
+            filenames=None, fragment=None, publishes=None):
         """ Registers a converter function for a given predicate.
-        All source files will be checked against `predicate(source)`
+        Source files with one of the given `extensions` (including the
+        leading dot) or `filenames` are handled by the converter without
+        calling the predicate. All other source files will be checked
+        against `predicate(source)` if a predicate is given.
         If the predicate returns a True value, the source will be
         converted as pages by calling converter with:
         `converter(source, **context)` where source is the path to source
-        file to convert and context created from `template_context` """
-        self.converters.append((predicate, converter))
+        file to convert and context created from `template_context`.
+        The first registered converter handling a source is used.
+        If given, `fragment(source, **context)` must return the theme,
+        the converted content and the context the converter renders
+        with `render_template`, allowing pages to be streamed.
+        If given, `publishes(source)` must return True if the page
+        links to the source file, which is then published as is
+        next to the page (previews of large files). """
+        self.converters.append((predicate, converter,
+            frozenset(extensions or ()), frozenset(filenames or ())))
+        if fragment is not None:
+            self.fragments[converter] = fragment
+        if publishes is not None:
+            self.publishers[converter] = publishes
+        self.converter_index = None
+        self.converter_cache = {}
         return self
 
+    def index_converters(self):
+        """ Builds the index used to find the converter for a source.
+        Maps each declared extension and filename to the ordered
+        candidate converters: any converter with a predicate registered
+        before the first converter declaring it. Undeclared sources
+        fall back to the converters with predicates. Resolved
+        converters are memoized per source path. """
+
+        def candidates(declares):
+            found = []
+            for predicate, converter, extensions, filenames in \
+                    self.converters:
+                if declares(extensions, filenames):
+                    found.append((None, converter))
+                    break
+                elif predicate:
+                    found.append((predicate, converter))
+            return found
+
+        extensions = set()
+        filenames = set()
+        for _, _, exts, names in self.converters:
+            extensions.update(exts)
+            filenames.update(names)
+
+        index = {}
+        for ext in extensions:
+            index[ext] = candidates(lambda e, n: ext in e)
+        for name in filenames:
+            _, ext = os.path.splitext(name)
+            index[name] = candidates(lambda e, n: name in n or ext in e)
+
+        self.converter_index = index
+        self.converter_fallback = candidates(lambda e, n: False)
+        self.converter_cache = {}
+        return index
+
+    def converter_for(self, source):
+        """ Returns the converter for source or None if not a page """
+        try:
+            return self.converter_cache[source]
+        except KeyError:
+            pass
+
+        index = self.converter_index
+        if index is None:
+            index = self.index_converters()
+
+        base = os.path.basename(source)
+        candidates = index.get(base)
+        if candidates is None:
+            _, ext = os.path.splitext(base)
+            candidates = index.get(ext, self.converter_fallback)
+
+        found = None
+        for predicate, converter in candidates:
+            if predicate is None or predicate(source):
+                found = converter
+                break
+
+        self.converter_cache[source] = found
+        return found
+
     def theme(self, theme, **kwargs):
         """ Sets configuration for a specified theme.
         Stores all kwargs into configuration per theme.
@@ -64,13 +182,19 @@ class Config:
         return name.replace("_", " ").title()
 
     def breadcrumb(self, site_root, destination):
-        """ Generates a breadcrumb for the specified destination file """
+        """ Generates a breadcrumb for the specified destination file.
+        Breadcrumbs are memoized per destination directory """
 
         outputdir = self.outputdir
         prefix = len(outputdir) + len(os.path.sep)
         destdir = os.path.dirname(destination[prefix:])
-        dest = destination[:prefix]
 
+        key = (site_root, destdir)
+        cached = self.breadcrumb_cache.get(key)
+        if cached is not None:
+            return list(cached)
+
+        dest = destination[:prefix]
         pages = []
         pages.append(self.page(site_root,
             os.path.join(outputdir, 'index.html')))
@@ -80,12 +204,20 @@ class Config:
                 pages.append(self.page(site_root,
                     os.path.join(dest, 'index.html')))
 
+        self.breadcrumb_cache[key] = tuple(pages)
         return pages
 
     def page(self, site_root, destination):
         """ Creates a page passed to template context for destination.
-        Page must contain a title attribute which is used for sorting."""
-        return TemplatePage(self, site_root, destination)
+        Page must contain a title attribute which is used for sorting.
+        Pages are interned, so the title of a destination is only
+        generated once and pages are shared by all listings """
+        key = (site_root, destination)
+        page = self.page_cache.get(key)
+        if page is None:
+            page = self.page_cache[key] = TemplatePage(self, site_root,
+                                                       destination)
+        return page
 
     def pages(self, site_root, dests):
         """ Creates and sorts pages for the given destination """
@@ -97,51 +229,249 @@ class Config:
         """ Creates the template environment to load themes
         from the themedir. The environment is stored in
         self.environment and can be used in content_template.
-        Sets up a Jinja2 environment by default."""
+        Sets up a Jinja2 environment by default, caching compiled
+        templates in .mvw/cache/templates if template_cache is set."""
 
         from jinja2 import Environment, FileSystemLoader
-        return Environment(loader=FileSystemLoader(templatedir))
+        return Environment(loader=FileSystemLoader(templatedir),
+                           bytecode_cache=self.bytecode_cache())
+
+    def bytecode_cache(self):
+        """ Returns the Jinja2 bytecode cache in .mvw/cache/templates
+        or None if template_cache is disabled or there is no mvw root.
+        Compiled templates are shared across `mvw` processes and are
+        compiled again when the template source changes. """
+
+        root = getattr(self, 'root', None)
+        if not self.template_cache or not root or not os.path.isdir(root):
+            return None
+
+        directory = os.path.join(root, 'cache', 'templates')
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Created by another process
+                if not os.path.isdir(directory):
+                    return None
+
+        from jinja2 import FileSystemBytecodeCache
+        return FileSystemBytecodeCache(directory)
+
+    @property
+    def environment(self):
+        """ The template environment for the templatedir.
+        Created with template_environment when first used """
+        environment = getattr(self, '_environment', None)
+        if environment is None:
+            environment = self.template_environment(self.templatedir)
+            self._environment = environment
+        return environment
+
+    @environment.setter
+    def environment(self, environment):
+        self._environment = environment
+        self.content_templates = {}
+
+    def content_template_name(self, theme):
+        """ The name of the template to use for parsed content.
+        Default implementation uses content_template from theme_get
+        with default value ${theme}.html """
+
+        return self.theme_get(theme, 'content_template', '%s.html' % theme)
 
     def content_template(self, theme):
         """ The template to use for parsed content.
-        Default implementation attempts to load content_template
-        using theme_get with default value ${theme}.html
-        Loads template using environment.get_template (as Jinja2)."""
+        Loads template named by content_template_name
+        using environment.get_template (as Jinja2).
+        Templates are memoized per theme until the template
+        file changes (as Jinja2 `is_up_to_date`)."""
 
-        template = self.theme_get(theme, 'content_template', '%s.html' % theme)
+        template = self.content_templates.get(theme)
+        if template is not None and \
+                getattr(template, 'is_up_to_date', False):
+            return template
 
-        return self.environment.get_template(template)
+        name = self.content_template_name(theme)
+        template = self.environment.get_template(name)
+        self.content_templates[theme] = template
+        return template
 
     def template_context(self, source, dest, site_root, pages, children):
         """ Creates a template context to be used to convert and render.
         Default implementation stores title, breadcrumb, pages and children.
         The pages are siblings within same directory, children are index
         pages of subdirectories.  Both pages and children params have already
-        been created using `self.pages` """
+        been created using `self.pages`. Pages of the breadcrumb are
+        removed from pages, reusing the result for the next page of
+        the same directory with the same pages """
 
         breadcrumb = self.breadcrumb(site_root, dest)
-        pages = [p for p in pages if p not in breadcrumb]
-
-        context = dict(title=self.title(dest),
+        key = (site_root, os.path.dirname(dest))
+        listing = self.listing_cache
+        if listing is None or listing[0] is not pages or listing[1] != key:
+            crumbs = set(p.url for p in breadcrumb)
+            listing = (pages, key, [p for p in pages
+                                    if p.url not in crumbs])
+            self.listing_cache = listing
+        pages = list(listing[2])
+
+        context = dict(title=self.page(site_root, dest).title,
                        breadcrumb=breadcrumb,
                        pages=pages,
                        children=children)
         return context
 
     def render_template(self, theme, content, **context):
-        """ Renders the content for the given theme and context """
+        """ Renders the content for the given theme and context.
+        Content may be a string or an iterator of chunks """
+
+        if not isinstance(content, string_types):
+            return ''.join(self.stream_template(theme, content, **context))
 
         template = self.content_template(theme)
         context['content'] = content
-        rendered = template.render(context)
+        with span(self.profiler, 'render'):
+            rendered = template.render(context)
+
+        # Record templates used when generating with dependency tracking
+        dependencies = context.get('dependencies')
+        if dependencies is not None:
+            dependencies.extend(self.template_dependencies(theme))
+
         return rendered
 
+    def stream_template(self, theme, content, **context):
+        """ Renders the content for the given theme and context
+        as an iterator of chunks of the rendered page. Content
+        may be a string or an iterator of chunks """
+
+        template = self.content_template(theme)
+
+        # Record templates used when generating with dependency tracking
+        dependencies = context.get('dependencies')
+        if dependencies is not None:
+            dependencies.extend(self.template_dependencies(theme))
+
+        if isinstance(content, string_types):
+            context['content'] = content
+            return template.generate(context)
+
+        context['content'] = CONTENT_MARKER
+        return self.insert_chunks(template.generate(context), content)
+
+    @staticmethod
+    def insert_chunks(rendered, chunks):
+        """ Yields the rendered chunks of a page replacing the
+        first content placeholder by the content chunks """
+        for part in rendered:
+            if chunks is None or CONTENT_MARKER not in part:
+                yield part.replace(CONTENT_MARKER, '')
+                continue
+
+            head, tail = part.split(CONTENT_MARKER, 1)
+            yield head
+            for chunk in chunks:
+                yield chunk
+            chunks = None
+            yield tail.replace(CONTENT_MARKER, '')
+
+    def fingerprint(self):
+        """ Returns a fingerprint of the configuration that affects
+        generated output. A change in the fingerprint causes
+        `mvw generate` to regenerate every page. """
+        from mvw.manifest import hashfile, hashvalue
+
+        mvwconfig = os.path.join(self.root, 'mvwconfig.py')
+        if os.path.isfile(mvwconfig):
+            mvwconfig = hashfile(mvwconfig)
+        else:
+            mvwconfig = None
+
+        return hashvalue([mvwconfig,
+                          self.sourcedir,
+                          self.outputdir,
+                          self.themedir,
+                          self.templatedir,
+                          self.site_root,
+                          self.breadcrumb_home,
+                          self.search,
+                          repr(sorted((self.themes or {}).items()))])
+
+    def template_dependencies(self, theme):
+        """ Returns the paths of the template files used to render
+        theme, including templates it extends, includes or imports.
+        All templates are returned if a template is selected
+        dynamically. Resolved dependencies are cached per theme
+        until one of the template files is modified. """
+
+        cache = self.template_dependencies_cache
+        cached = cache.get(theme)
+        if cached is not None:
+            mtimes, paths = cached
+            if mtimes == [self.mtime(p) for p in paths]:
+                return paths
+
+        from jinja2 import meta
+
+        env = self.environment
+        names = [self.content_template_name(theme)]
+        found = {}
+        while names:
+            name = names.pop()
+            if name in found:
+                continue
+            source, path, _ = env.loader.get_source(env, name)
+            found[name] = path
+            for ref in meta.find_referenced_templates(env.parse(source)):
+                if ref is None:
+                    names.extend(env.list_templates())
+                else:
+                    names.append(ref)
+
+        paths = sorted(found.values())
+        cache[theme] = ([self.mtime(p) for p in paths], paths)
+        return paths
+
+    def template_files(self):
+        """ Returns the paths of all files in the templatedir """
+        paths = []
+        for root, dirs, files in os.walk(self.templatedir):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            paths.extend(os.path.join(root, f) for f in files
+                         if not f.startswith('.'))
+        return sorted(paths)
+
+    def large_file(self, source):
+        """ Returns large_file_mode if source is at least
+        large_file_size bytes, otherwise None. Converters stream
+        (`stream`), preview (`preview`) or skip (`skip`) converting
+        large files """
+        if not self.large_file_size or not source:
+            return None
+        try:
+            size = os.path.getsize(source)
+        except OSError:
+            return None
+        if size < self.large_file_size:
+            return None
+        return self.large_file_mode
+
+    @staticmethod
+    def mtime(path):
+        """ Returns the modification time of path or None """
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return None
+
     def load(self, root, defaults):
         """ Loads and configures remaining config properties.
         Called after running custom mvwconfig.py if it exists """
 
         root = self.expandpath(root)
         defaults = self.expandpath(defaults)
+        self.root = root
 
         # Load sourcedir with default same directory that contains .mvw
         self.sourcedir = self.expandpath(self.sourcedir, root)
@@ -167,7 +497,29 @@ class Config:
         template = os.path.join(self.themedir, 'template')
         if not os.path.isdir(template):
             template = os.path.join(defaults, 'theme', 'template')
-        self.environment = self.template_environment(template)
+        self.templatedir = template
+        self._environment = None
+        self.content_templates = {}
+
+        # Caches of highlighted code and converted fragments
+        # shared by converters under .mvw/cache if there is a mvw root
+        from mvw.cache import DiskCache
+        self.highlight_cache = None
+        self.fragment_cache = None
+        cached = os.path.isdir(root)
+        if cached and self.highlight_cache_size:
+            self.highlight_cache = DiskCache(
+                    os.path.join(root, 'cache', 'highlight'),
+                    self.highlight_cache_size)
+        if cached and self.fragment_cache_size:
+            self.fragment_cache = DiskCache(
+                    os.path.join(root, 'cache', 'fragments'),
+                    self.fragment_cache_size)
+        self._fragment_settings = None
+        self.template_dependencies_cache = {}
+        self.page_cache = {}
+        self.breadcrumb_cache = {}
+        self.listing_cache = None
 
         # Load theme public, using default if does not exist
         themepublic = os.path.join(self.themedir, 'public')
@@ -192,33 +544,155 @@ class Config:
             from mvw.converters.pygmentsconvert import PygmentsConverter
             PygmentsConverter(self)
 
+        self.index_converters()
+
         return self
 
+    def publishes_source(self, source):
+        """ Returns True if the page converted from source links to
+        the source file, which must be published with the page """
+        publishes = self.publishers.get(self.converter_for(source))
+        return publishes is not None and bool(publishes(source))
+
     def is_page(self, source):
         """ Returns True if a converter exists for the given source file """
-        if source and os.path.exists(source):
-            for (predicate, _) in self.converters:
-                if predicate(source):
-                    return True
-        return False
+        return bool(source) and self.converter_for(source) is not None \
+            and os.path.exists(source)
 
     def convert(self, source, **context):
         """ Converts the given source file. """
 
         converter = None
         if source and os.path.exists(source):
-            for (predicate, converter) in self.converters:
-                if (predicate(source)):
-                    converter = converter
-                    break
-
-        if(converter):
+            converter = self.converter_for(source)
+
+        if converter in self.fragments:
+            # Convert with the cached fragment when available
+            theme, content, context = self.fragment(converter, source,
+                                                    **context)
+            self.search_document(content, context)
+            return self.render_template(theme, content, **context)
+        elif(converter):
             # Convert with first converter that source file
-            return converter(source, **context)
+            self.search_document(None, context)
+            profiler = self.profiler
+            if profiler is None:
+                return converter(source, **context)
+            with span(profiler, 'convert', converter=describe(converter)):
+                return converter(source, **context)
         else:
             # Simply render empty content in default template
+            self.search_document("", context)
             return self.render_template('default', "", **context)
 
+    def stream(self, source, **context):
+        """ Converts the given source file as an iterator of chunks
+        of the rendered page. Pages of converters registered with a
+        fragment function are rendered as they are consumed, only
+        holding the converted content in memory. Pages of other
+        converters are converted at once. """
+
+        converter = None
+        if source and os.path.exists(source):
+            converter = self.converter_for(source)
+
+        if not converter:
+            self.search_document("", context)
+            return self.stream_template('default', "", **context)
+
+        fragment = self.fragments.get(converter)
+        if fragment is None:
+            self.search_document(None, context)
+            return iter([converter(source, **context)])
+
+        theme, content, context = self.fragment(converter, source, **context)
+        self.search_document(content, context)
+        return self.stream_template(theme, content, **context)
+
+    @staticmethod
+    def search_document(content, context):
+        """ Stores the searchable document of a page with content
+        in the `search_document` dict of context if provided. Only
+        the title of pages of converters without a fragment function
+        is indexed """
+        document = context.get('search_document')
+        if document is not None:
+            from mvw import search
+            document.update(search.document(context.get('title'),
+                                            context.get('Meta'), content))
+
+    def fragment(self, converter, source, **context):
+        """ Converts the source file with the fragment function
+        registered for converter. Returns the theme, converted content
+        and context to render. Fragments are cached in `fragment_cache`
+        by a hash of the source, its file name (converters may select a
+        lexer by name), the converter and `fragment_settings`, so pages
+        are only rendered again if only templates changed.
+        Fragments adding context that cannot be stored as JSON
+        or of large files are not cached """
+
+        fragment = self.fragments[converter]
+        profiler = self.profiler
+        cache = self.fragment_cache
+        if cache is not None and self.large_file(source):
+            cache = None
+        if cache is None and profiler is None:
+            return fragment(source, **context)
+
+        with span(profiler, 'convert', converter=describe(converter)):
+            if cache is None:
+                return fragment(source, **context)
+
+            import json
+            from mvw.manifest import hashfile, hashvalue
+
+            key = hashvalue(['fragment', describe(converter),
+                             self.fragment_settings(),
+                             os.path.basename(source), hashfile(source)])
+            cached = cache.get(key)
+            if cached is not None:
+                cached = json.loads(cached)
+                context.update(cached['context'])
+                return cached['theme'], cached['content'], context
+
+            theme, content, converted = fragment(source, **context)
+
+            # Store context added or replaced by the converter
+            added = dict((k, v) for k, v in converted.items()
+                         if k not in context or context[k] is not v)
+            try:
+                cached = json.dumps(dict(theme=theme, content=content,
+                                         context=added))
+            except (TypeError, ValueError):
+                pass
+            else:
+                cache.put(key, cached)
+            return theme, content, converted
+
+    def fragment_settings(self):
+        """ Returns the settings converted fragments depend on other
+        than their source: the hash of the mvwconfig.py, the theme
+        settings and the versions of Markdown and Pygments """
+
+        settings = self._fragment_settings
+        if settings is None:
+            import markdown
+            import pygments
+            from mvw.manifest import hashfile
+
+            mvwconfig = os.path.join(self.root, 'mvwconfig.py')
+            if os.path.isfile(mvwconfig):
+                mvwconfig = hashfile(mvwconfig)
+            else:
+                mvwconfig = None
+
+            settings = self._fragment_settings = [
+                mvwconfig,
+                repr(sorted((self.themes or {}).items())),
+                getattr(markdown, 'version', None) or markdown.__version__,
+                pygments.__version__]
+        return settings
+
     @staticmethod
     def expandpath(path, root=None):
         """ Fully expands path appending
@@ -233,8 +707,11 @@ class Config:
         return os.path.abspath(path)
 
 
-class TemplatePage:
-    """ Encapsulates data for a page to include in the template """
+class TemplatePage(object):
+    """ Encapsulates data for a page to include in the template.
+    Pages are compared and hashed by url """
+
+    __slots__ = ('title', 'url')
 
     def __init__(self, config, site_root, destination):
         self.title = config.title(destination)
@@ -247,3 +724,6 @@ class TemplatePage:
 
     def __ne__(self, other):
         return self.url != other.url
+
+    def __hash__(self):
+        return hash(self.url)
@@ -3,48 +3,171 @@ Theme is taken from Markdown meta data, or default if not set.
 Extensions can be configured per theme using `markdown_extensions`
 theme key.  Context contains all meta data lists as `Meta` and as
 joined strings as `meta`. Markdown is parsed and then rendered
-with template using theme from meta data or default."""
+with template using theme from meta data or default.
+Markdown is imported when the first source is converted."""
 
-import os
+import re
 import codecs
-from markdown import Markdown
-from markdown.extensions.meta import MetaPreprocessor
+import threading
+
+from mvw.manifest import hashvalue
+
+# Same syntax as the Markdown meta data extension
+META_RE = re.compile(r'^[ ]{0,3}(?P<key>[A-Za-z0-9_-]+):\s*(?P<value>.*)')
+META_MORE_RE = re.compile(r'^[ ]{4,}(?P<value>.*)')
+BEGIN_RE = re.compile(r'^-{3}(\s.*)?')
+END_RE = re.compile(r'^(-{3}|\.{3})(\s.*)?')
+
+
+def front_matter(text):
+    """ Scans meta data from the start of Markdown text.
+    Returns the meta data as a dict of lists of values by lower case
+    key and the remaining text. Parses the same syntax as the Markdown
+    meta data extension without creating a Markdown instance. """
+
+    meta = {}
+    key = None
+    start = 0
+    end = len(text)
+
+    def line_at(pos):
+        nl = text.find('\n', pos)
+        return (text[pos:], end) if nl < 0 else (text[pos:nl], nl + 1)
+
+    if text:
+        line, after = line_at(0)
+        if BEGIN_RE.match(line):
+            start = after
+
+    while start < end:
+        line, after = line_at(start)
+        if line.strip() == '' or END_RE.match(line):
+            # blank line or end of YAML header - done
+            start = after
+            break
+
+        m1 = META_RE.match(line)
+        if m1:
+            key = m1.group('key').lower().strip()
+            meta.setdefault(key, []).append(m1.group('value').strip())
+        else:
+            m2 = META_MORE_RE.match(line)
+            if m2 and key:
+                # Add another line to existing key
+                meta[key].append(m2.group('value').strip())
+            else:
+                break  # no meta data - done
+        start = after
+
+    return meta, text[start:]
+
+
+class CachedHilite:
+    """ Tree processor replacing the one of the codehilite extension.
+    Highlights code blocks the same way, caching highlighted blocks
+    by a hash of the code, the extension configuration and the
+    Markdown and Pygments versions. """
+
+    def __init__(self, md, hiliter, cache):
+        self.markdown = md
+        self.config = hiliter.config
+        self.cache = cache
+
+    def run(self, root):
+        """ Find code blocks and store in htmlStash. """
+        for block in root.iter('pre'):
+            if len(block) == 1 and block[0].tag == 'code':
+                placeholder = self.markdown.htmlStash.store(
+                        self.hilite(block[0].text), safe=True)
+                # Clear codeblock and change to p element which will
+                # later be removed when inserting raw html
+                block.clear()
+                block.tag = 'p'
+                block.text = placeholder
+
+    def hilite(self, text):
+        """ Returns the highlighted html of a code block """
+        import markdown
+        import pygments
+        from markdown.extensions.codehilite import CodeHilite
+
+        config = self.config
+        tab_length = self.markdown.tab_length
+        key = hashvalue(['codehilite', markdown.version,
+                         pygments.__version__, sorted(config.items()),
+                         tab_length, text])
+        html = self.cache.get(key)
+        if html is None:
+            code = CodeHilite(text,
+                              linenums=config['linenums'],
+                              guess_lang=config['guess_lang'],
+                              css_class=config['css_class'],
+                              style=config['pygments_style'],
+                              noclasses=config['noclasses'],
+                              tab_length=tab_length,
+                              use_pygments=config['use_pygments'])
+            html = code.hilite()
+            self.cache.put(key, html)
+        return html
 
 
 class MarkdownConverter:
+    extensions = ['.md', '.markdown']
+
     def __init__(self, config):
         self.config = config
-        config.converter(self.handles, self.convert)
+        self.local = threading.local()
+        config.converter(None, self.convert, extensions=self.extensions,
+                fragment=self.fragment)
 
     def convert(self, source, **context):
         """ Converts the source file and saves to the destination """
+        theme, content, context = self.fragment(source, **context)
+        return self.config.render_template(theme, content, **context)
+
+    def fragment(self, source, **context):
+        """ Converts the source file to html content.
+        Returns the theme, content and context to render """
         with codecs.open(source, encoding='utf-8') as src:
-            lines = src.readlines()
+            text = src.read()
 
         # Parse metadata first so we can get theme extensions
-        md = Markdown()
-        lines = MetaPreprocessor(md).run(lines)
-
-        Meta = md.Meta
+        Meta, text = front_matter(text)
         meta = {k: ' '.join(v) for k, v in Meta.items()}
 
         # Load theme from meta data if set
         theme = meta.get('theme', 'default')
 
-        exts = self.config.theme_get(theme, 'markdown_extensions', [
-            'codehilite(css_class=syntax,guess_lang=False)'])
-        exts = filter(None, exts)  # Removes empty lines
-
-        md = Markdown(extensions=exts)
-        md.Meta = meta  # restore already parsed meta data
-
-        content = md.convert(''.join(lines))
+        md = self.markdown(theme)
+        md.reset()
+        content = md.convert(text)
 
         context['Meta'] = Meta
         context['meta'] = meta
 
-        return self.config.render_template(theme, content, **context)
+        return theme, content, context
+
+    def markdown(self, theme):
+        """ Returns the Markdown instance configured for theme.
+        Instances are created once per theme and thread and
+        must be reset before converting another document. """
+
+        engines = getattr(self.local, 'engines', None)
+        if engines is None:
+            engines = self.local.engines = {}
+
+        md = engines.get(theme)
+        if md is None:
+            from markdown import Markdown
+            exts = self.config.theme_get(theme, 'markdown_extensions', [
+                'codehilite(css_class=syntax,guess_lang=False)'])
+            exts = [e for e in exts if e]  # Removes empty lines
+            md = engines[theme] = Markdown(extensions=exts)
+
+            # Cache code blocks highlighted by codehilite
+            cache = self.config.highlight_cache
+            if cache is not None and 'hilite' in md.treeprocessors:
+                md.treeprocessors['hilite'] = CachedHilite(
+                        md, md.treeprocessors['hilite'], cache)
 
-    def handles(self, source):
-        _, ext = os.path.splitext(source)
-        return ext in ['.md', '.markdown']
+        return md
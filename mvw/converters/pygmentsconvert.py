@@ -1,34 +1,242 @@
 """ Converter using Pygments.
 Registers Pygments for all lexer file types. Should
 be registered first to allow overriding other converters
-for specific extensions (markdown, etc). """
+for specific extensions (markdown, etc). Pygments is imported
+when the first source is tested or converted.
+
+Sources of at least `config.large_file_size` bytes are memory
+mapped and, depending on `config.large_file_mode`, highlighted in
+chunks as the page is written (`stream`), highlighted up to
+`config.large_file_preview_size` bytes with a link to the source
+(`preview`) or not converted and published as is (`skip`). """
 
 import codecs
+import os
+import fnmatch
+import mmap
+import re
+import threading
+try:
+    # Try python 3 packages
+    from html import escape
+    from urllib.parse import quote
+except ImportError:
+    # Try python 2 packages
+    from cgi import escape
+    from urllib import quote
+
+from mvw.manifest import hashvalue
+
+# Filename patterns of the form *.ext matched by suffix
+SIMPLE_PATTERN = re.compile(r'^\*(\.[^.*?\[\]]+)$')
+
+# Bytes of large files highlighted at once when streaming
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+
+def highlight(code, lexer, formatter, cache=None):
+    """ Highlights code with lexer and formatter. If a cache is given,
+    highlighted code is cached by a hash of the code, the lexer and
+    formatter classes and options and the Pygments version so code
+    is only tokenized once. """
+    import pygments
+    if cache is None:
+        return pygments.highlight(code, lexer, formatter)
+
+    key = hashvalue(['pygments', pygments.__version__,
+                     describe(lexer), describe(formatter), code])
+    content = cache.get(key)
+    if content is None:
+        content = pygments.highlight(code, lexer, formatter)
+        cache.put(key, content)
+    return content
+
+
+def read_chunks(source, size):
+    """ Yields the lines of source in chunks of about size bytes
+    decoded as UTF-8. The source is memory mapped and chunks
+    end at line breaks """
+    with open(source, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            start = 0
+            length = len(data)
+            while start < length:
+                end = data.find(b'\n', start + size) + 1 or length
+                yield data[start:end].decode('utf-8', 'replace')
+                start = end
+        finally:
+            data.close()
+
+
+def describe(obj):
+    """ Returns the class and options of a lexer or formatter """
+    cls = obj.__class__
+    options = sorted((k, repr(v)) for k, v in obj.options.items())
+    return ['%s.%s' % (cls.__module__, cls.__name__), options]
+
+
+class LexerIndex:
+    """ Resolves lexer classes for filenames without scanning the
+    filename patterns of every lexer for each file.
+
+    Patterns of the form `*.ext` are indexed by suffix. All other
+    patterns (exact names, `*.[ch]`, `Makefile.*`, ...) are compiled
+    into a single regular expression. Filenames that only match suffix
+    patterns resolve to the same lexer as any other filename with the
+    same matching suffixes, so lookups are cached by those suffixes.
+    Other filenames are cached by name. Misses are cached as None. """
+
+    def __init__(self):
+        from pygments.lexers import get_all_lexers
+
+        suffixes = set()
+        patterns = set()
+        for _, _, filenames, _ in get_all_lexers():
+            for pattern in filenames:
+                simple = SIMPLE_PATTERN.match(pattern)
+                if simple:
+                    suffixes.add(simple.group(1))
+                else:
+                    patterns.add(pattern)
+
+        self.suffixes = suffixes
+        self.patterns = re.compile('|'.join(
+            '(?:%s)' % fnmatch.translate(p) for p in sorted(patterns)))
+        self.cache = {}
+
+    def lexer_class(self, filename):
+        """ Returns the lexer class for filename or None """
+
+        if self.patterns.match(filename):
+            key = filename
+        else:
+            key = tuple(filename[i:] for i, c in enumerate(filename)
+                        if c == '.' and filename[i:] in self.suffixes)
+            if not key:
+                return None
 
-from pygments import highlight
-from pygments.formatters import HtmlFormatter
-from pygments.lexers import get_lexer_for_filename
+        try:
+            return self.cache[key]
+        except KeyError:
+            from pygments.lexers import find_lexer_class_for_filename
+            cls = find_lexer_class_for_filename(filename)
+            self.cache[key] = cls
+            return cls
 
 
 class PygmentsConverter:
+    index = None
+    lock = threading.Lock()
+
     def __init__(self, config):
         self.config = config
-        config.converter(self.handles, self.convert)
+        self.local = threading.local()
+        config.converter(self.handles, self.convert, fragment=self.fragment,
+                publishes=self.publishes)
+
+    @classmethod
+    def lexer_index(cls):
+        """ Returns the LexerIndex shared by all converters,
+        built when first needed """
+        if cls.index is None:
+            with cls.lock:
+                if cls.index is None:
+                    cls.index = LexerIndex()
+        return cls.index
 
     def convert(self, source, **context):
         """ Converts the source file and saves to the destination """
+        theme, content, context = self.fragment(source, **context)
+        return self.config.render_template(theme, content, **context)
+
+    def fragment(self, source, **context):
+        """ Highlights the source file as html content.
+        Returns the theme, content and context to render.
+        Content of large files is streamed or a preview """
+        theme = 'default'
+        lexer = self.lexer(source)
+
+        mode = self.config.large_file(source)
+        if mode == 'stream':
+            return theme, self.stream(source, lexer), context
+        elif mode:
+            return theme, self.preview(source, lexer), context
+
         with codecs.open(source, encoding='utf-8') as src:
             code = src.read()
 
-        theme = 'default'
-        lexer = get_lexer_for_filename(source)
-        formatter = HtmlFormatter(linenos=False, cssclass='syntax')
-        content = highlight(code, lexer, formatter)
+        content = highlight(code, lexer, self.formatter(),
+                            self.config.highlight_cache)
 
-        return self.config.render_template(theme, content, **context)
+        return theme, content, context
+
+    def stream(self, source, lexer):
+        """ Highlights the source file in chunks as they are consumed.
+        Chunks are lexed on their own, so tokens spanning lines
+        (strings, comments) may be highlighted differently at
+        the start of a chunk """
+        import pygments
+        from pygments.formatters import HtmlFormatter
+
+        # Keep blank lines at the start and end of chunks
+        lexer = lexer.__class__(**dict(lexer.options, stripnl=False))
+        formatter = HtmlFormatter(nowrap=True)
+
+        yield '<div class="syntax"><pre>'
+        for code in read_chunks(source, STREAM_CHUNK_SIZE):
+            yield pygments.highlight(code, lexer, formatter)
+        yield '</pre></div>\n'
+
+    def preview(self, source, lexer):
+        """ Highlights up to `config.large_file_preview_size` bytes
+        of the source file followed by a link to the source """
+        size = os.path.getsize(source)
+        limit = self.config.large_file_preview_size
+        with open(source, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                end = data.rfind(b'\n', 0, limit) + 1 or min(limit, size)
+                code = data[:end].decode('utf-8', 'replace')
+            finally:
+                data.close()
+
+        content = highlight(code, lexer, self.formatter(),
+                            self.config.highlight_cache)
+        name = os.path.basename(source)
+        return '%s<p class="preview">Showing the first %d of %d bytes. ' \
+            '<a href="%s">%s</a></p>\n' % (content, end, size,
+                                            quote(name), escape(name))
+
+    def lexer(self, source):
+        """ Returns the lexer instance for the source file.
+        Lexers are created once per lexer class and thread """
+        lexers = getattr(self.local, 'lexers', None)
+        if lexers is None:
+            lexers = self.local.lexers = {}
+
+        cls = self.lexer_index().lexer_class(os.path.basename(source))
+        lexer = lexers.get(cls)
+        if lexer is None:
+            lexer = lexers[cls] = cls()
+        return lexer
+
+    def formatter(self):
+        """ Returns the formatter instance for the current thread """
+        formatter = getattr(self.local, 'formatter', None)
+        if formatter is None:
+            from pygments.formatters import HtmlFormatter
+            formatter = self.local.formatter = HtmlFormatter(
+                    linenos=False, cssclass='syntax')
+        return formatter
+
+    def publishes(self, source):
+        """ Returns True if the page of source is a preview
+        linking to the source file """
+        return self.config.large_file(source) == 'preview'
 
     def handles(self, source):
-        try:
-            return get_lexer_for_filename(source) is not None
-        except:
+        index = self.lexer_index()
+        if index.lexer_class(os.path.basename(source)) is None:
             return False
+        return self.config.large_file(source) != 'skip'
@@ -24,6 +24,78 @@ config = Config()
 # serve a static site to serve elsewhere.
 #config.port=8000
 
+# Maximum size in bytes of pages rendered by `mvw serve`
+# kept in memory. Cached pages are served without
+# regenerating until their source, directory or
+# templates change.
+#config.serve_cache_size = 64 * 1024 * 1024
+
+# Write compressed .gz (and .br if the brotli module is
+# installed) copies of generated text files of the listed
+# types that are at least compress_min_size bytes when
+# generating the site. Same as `mvw generate --compress`.
+# `mvw serve` compresses responses of these types.
+#config.precompress = False
+#config.compress_min_size = 1024
+#config.compress_types = ['.html', '.css', '.js', '.svg',
+#                         '.txt', '.xml', '.json']
+
+# Maximum size in bytes of the cache of highlighted code
+# in .mvw/cache/highlight. Code files and code blocks are
+# only highlighted again when they change. Set to 0 to
+# disable the cache.
+#config.highlight_cache_size = 128 * 1024 * 1024
+
+# Maximum size in bytes of the cache of converted pages
+# in .mvw/cache/fragments. Pages are only rendered with
+# their templates again when only templates changed.
+# Set to 0 to disable the cache.
+#config.fragment_cache_size = 256 * 1024 * 1024
+
+# Cache compiled templates in .mvw/cache/templates so
+# templates are only compiled again when they change.
+#config.template_cache = True
+
+# Source code files of at least large_file_size bytes are
+# highlighted in chunks as pages are written ('stream'),
+# only highlighted up to large_file_preview_size bytes with
+# a link to the source ('preview') or published as is
+# without a page ('skip'). Set large_file_size to 0 to
+# always highlight the whole file.
+#config.large_file_size = 16 * 1024 * 1024
+#config.large_file_mode = 'preview'
+#config.large_file_preview_size = 256 * 1024
+
+# Write a search index of the titles, meta data and text
+# of pages to _search when generating the site, used by
+# the search form of the default theme. `mvw serve` indexes
+# sources in memory and answers searches at /_search?q=
+#config.search = True
+
+# How static files are published when generating the site.
+# 'copy' copies files, 'kernel' copies files within the kernel,
+# 'reflink' clones files on copy on write file systems and
+# 'hardlink' links generated files to sources (do not edit
+# the generated files). Unsupported strategies fall back
+# to 'kernel' and then 'copy'.
+#config.publish = 'copy'
+
+# Number of threads handling requests concurrently
+# in `mvw serve`. Set to 0 to handle one at a time.
+#config.serve_workers = 8
+
+# Pages of sources of at least serve_stream_size bytes
+# are sent by `mvw serve` as they are rendered rather
+# than cached, limiting memory used by large files.
+#config.serve_stream_size = 1024 * 1024
+
+# Watch the source and theme directories in `mvw serve`.
+# Changed pages are regenerated ahead of requests and
+# open pages reload when they change. Changes within
+# watch_debounce seconds of each other are handled once.
+#config.serve_watch = True
+#config.watch_debounce = 0.25
+
 # Directories are relative to mvw root (.mvw), but
 # can be absolute.
 #config.sourcedir = '..'
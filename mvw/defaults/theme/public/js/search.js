@@ -0,0 +1,129 @@
+/* Search of pages of a site generated by MVW.
+ * Shards of the search index are loaded as terms are searched:
+ * `ab.json` maps terms starting with `ab` to flat lists of page
+ * ids and weights and `pages.json` lists the url and title of
+ * every page by id. Terms are matched as in mvw/search.py, the
+ * last term of a query also matches as a prefix. Pages served by
+ * `mvw serve` are searched with its search endpoint instead. */
+(function() {
+    var form = document.getElementById('search');
+    if (!form || !window.fetch) {
+        return;
+    }
+
+    var index = form.getAttribute('data-index');
+    var input = form.elements.q;
+    var list = document.getElementById('search-results');
+    var loaded = {};
+    var limit = 20;
+    var timer = null;
+
+    function load(name) {
+        if (!loaded[name]) {
+            loaded[name] = fetch(index + encodeURIComponent(name) + '.json')
+                .then(function(r) { return r.ok ? r.json() : {}; })
+                .catch(function() { return {}; });
+        }
+        return loaded[name];
+    }
+
+    function terms(text) {
+        return (text.toLowerCase().match(/[\p{L}\p{N}]+/gu) || [])
+            .filter(function(t) { return t.length >= 2 && t.length <= 32; });
+    }
+
+    function shard(term) {
+        if (/^[a-z0-9]{2}/.test(term)) {
+            return term.slice(0, 2);
+        }
+        return '_' + term.codePointAt(0).toString(16);
+    }
+
+    function matches(postings, term, prefix) {
+        var found = {};
+        Object.keys(postings).forEach(function(t) {
+            if (t === term || (prefix && t.lastIndexOf(term, 0) === 0)) {
+                var flat = postings[t];
+                for (var i = 0; i < flat.length; i += 2) {
+                    found[flat[i]] = Math.max(found[flat[i]] || 0, flat[i + 1]);
+                }
+            }
+        });
+        return found;
+    }
+
+    function endpoint(query) {
+        return fetch(index + '?q=' + encodeURIComponent(query))
+            .then(function(r) { return r.json(); })
+            .then(function(r) { return r.results; });
+    }
+
+    function search(query) {
+        if (index.charAt(index.length - 1) !== '/') {
+            return endpoint(query);
+        }
+
+        var words = terms(query);
+        if (!words.length) {
+            return Promise.resolve([]);
+        }
+        var shards = words.map(function(t) { return load(shard(t)); });
+        return Promise.all([load('pages')].concat(shards)).then(function(r) {
+            var pages = r[0];
+            var total = pages.filter(Boolean).length || 1;
+            var scores = null;
+            words.forEach(function(t, w) {
+                var found = matches(r[w + 1], t, w === words.length - 1);
+                var idf = Math.log(1 + total / (Object.keys(found).length || 1));
+                var next = {};
+                Object.keys(found).forEach(function(id) {
+                    if (!scores || id in scores) {
+                        next[id] = (scores ? scores[id] : 0) + found[id] * idf;
+                    }
+                });
+                scores = next;
+            });
+            return Object.keys(scores)
+                .filter(function(id) { return pages[id]; })
+                .sort(function(a, b) { return scores[b] - scores[a]; })
+                .slice(0, limit)
+                .map(function(id) {
+                    return {url: pages[id][0], title: pages[id][1]};
+                });
+        });
+    }
+
+    function show(query) {
+        search(query).then(function(results) {
+            if (input.value !== query) {
+                return;
+            }
+            list.innerHTML = '';
+            results.forEach(function(page) {
+                var item = document.createElement('li');
+                var link = document.createElement('a');
+                link.href = page.url;
+                link.textContent = page.title || page.url;
+                item.appendChild(link);
+                if (page.snippet) {
+                    var text = document.createElement('small');
+                    text.textContent = page.snippet;
+                    item.appendChild(text);
+                }
+                list.appendChild(item);
+            });
+        });
+    }
+
+    input.addEventListener('input', function() {
+        clearTimeout(timer);
+        timer = setTimeout(function() { show(input.value); }, 100);
+    });
+    form.addEventListener('submit', function(e) {
+        e.preventDefault();
+        var first = list.querySelector('a');
+        if (first) {
+            location.href = first.href;
+        }
+    });
+})();
@@ -1,6 +1,46 @@
+import hashlib
 import os
-import shutil
-import codecs
+import time
+
+from mvw import compress
+from mvw.manifest import Manifest, hashfile, hashvalue, replace, \
+    temporary
+from mvw.profiler import span
+from mvw.publish import publish
+
+# Generator and pending conversions inherited by forked workers
+_pending = None
+
+
+def _convert_pending(index):
+    """ Converts a pending page within a worker process.
+    Returns the paths of the templates used to render the page,
+    the spans recorded converting it when profiling, its search
+    document when indexing and whether the page was written """
+    generator, pending = _pending
+    src, dest, pages, children, _ = pending[index]
+    templates = []
+    document = {} if generator.search is not None else None
+    profiler = generator.config.profiler
+    if profiler is None:
+        written = generator.convert(src, dest, pages, children, True,
+                                    templates, document=document)
+        return templates, None, document, written
+
+    mark = len(profiler.events)
+    written = generator.convert(src, dest, pages, children, True,
+                                templates, document=document)
+    return templates, profiler.events[mark:], document, written
+
+
+def cpu_count():
+    """ Returns the number of CPUs. multiprocessing is
+    only imported if os.cpu_count is not available """
+    count = getattr(os, 'cpu_count', lambda: None)()
+    if count is None:
+        import multiprocessing
+        count = multiprocessing.cpu_count()
+    return count
 
 
 class Generator:
@@ -11,16 +51,85 @@ class Generator:
         # Site root only valid in generate
         # everything else served from root
         self.site_root = '/'
-
-    def generate(self):
+        # Build manifest and dependency nodes only valid in generate
+        self.manifest = None
+        self.nodes = {}
+        self.full = True
+        self.jobs = 1
+        # URL of live reload events only set in serve
+        self.live_reload = None
+        # Classified source directory listings by source directory
+        self.listings = {}
+        # Search index only updated in generate
+        self.search = None
+        # URL of the search index or endpoint of the search form
+        self.search_url = None
+        # Files written, unchanged and removed by the last generate
+        self.written = 0
+        self.unchanged = 0
+        self.removed = 0
+
+    def generate(self, full=False, jobs=None):
         """ Generates the entire site.
-        Cleans the outputdir, includes the theme
-        and generates the source into the outputdir """
+        Includes the theme and generates the source into the outputdir.
+        Only sources that changed since the previous build are
+        converted or copied unless `full` is True. Outputs of
+        sources that have since been removed are deleted.
+        Converted pages are indexed for search if `config.search`.
+        Pages are converted by `jobs` worker processes,
+        defaulting to the number of CPUs. Files are only written if
+        their content changed, counted in `written`, `unchanged`
+        and `removed` """
 
         config = self.config
         self.site_root = config.site_root
-        self.generate_from(config.sourcedir)
-        self.generate_from(config.theme_public, copyonly=True)
+        self.full = full
+        self.jobs = jobs or cpu_count()
+        self.written = self.unchanged = self.removed = 0
+
+        profiler = config.profiler
+        with span(profiler, 'generate', 'build'):
+            with span(profiler, 'manifest'):
+                manifest = Manifest(os.path.join(config.root,
+                                                 'manifest.json'))
+                manifest.load()
+                self.manifest = manifest
+                self.nodes = {'config': config.fingerprint()}
+                if config.search:
+                    from mvw.search import SearchIndex
+                    self.search = SearchIndex(
+                            os.path.join(config.root, 'search.json'),
+                            os.path.join(config.outputdir, '_search'))
+                    self.search.load()
+                    self.search_url = '%s_search/' % self.site_root
+                    self.nodes['search'] = self.search.fingerprint()
+
+            try:
+                self.generate_from(config.sourcedir)
+                self.generate_from(config.theme_public, copyonly=True)
+
+                with span(profiler, 'manifest'):
+                    for dest in manifest.prune():
+                        if os.path.exists(dest):
+                            os.remove(dest)
+                            self.removed += 1
+                        compress.remove_siblings(dest)
+                        if self.search is not None:
+                            self.search.remove(self.url(dest))
+
+                    if not os.path.isdir(config.root):
+                        os.makedirs(config.root)
+                    if self.search is not None:
+                        with span(profiler, 'search'):
+                            self.search.save()
+                    manifest.save()
+            finally:
+                self.manifest = None
+                self.search = None
+                self.search_url = None
+                self.nodes = {}
+                self.full = True
+                self.jobs = 1
 
     def generate_from(self, sourcedir, copyonly=False):
         """ Generates and includes the source into the outputdir """
@@ -31,8 +140,14 @@ class Generator:
         config = self.config
         outputdir = config.outputdir
         prefix = len(sourcedir) + len(os.path.sep)
+        pending = []
+
+        profiler = config.profiler
+        walk = os.walk(sourcedir)
+        if profiler is not None:
+            walk = profiler.iterate(walk, 'walk')
 
-        for root, dirs, files in os.walk(sourcedir):
+        for root, dirs, files in walk:
             # Prune hidden directories and files
             dirs[:] = [d for d in dirs if not d.startswith('.')]
             files[:] = [f for f in files if not f.startswith('.')]
@@ -44,14 +159,31 @@ class Generator:
             sources = []
             for f in files:
                 src = os.path.join(root, f)
-                if copyonly or not config.is_page(src):
+                with span(profiler, 'classify'):
+                    page = not copyonly and config.is_page(src)
+                # Previews of large pages link to their published source
+                if not page or (config.publishes_source(src) and
+                                not f.endswith('.html')):
                     dest = os.path.join(destpath, f)
-                    shutil.copy(src, dest)
-                else:
+                    inputs = ['source:%s' % src]
+                    published = False
+                    if self.changed(dest, inputs):
+                        with span(profiler, 'publish'):
+                            published = publish(src, dest, config.publish)
+                        self.record(dest, inputs)
+                    self.count(published)
+                    self.precompress(dest, published)
+                if page:
                     base, _ = os.path.splitext(f)
                     dest = os.path.join(destpath, "%s%s" % (base, '.html'))
                     sources.append((src, dest))
 
+            # Sources with the same base name (foo.md and foo.py)
+            # generate the same page, the last one walked is kept
+            generated = dict((dest, src) for src, dest in sources)
+            sources = [(src, dest) for src, dest in sources
+                       if generated[dest] == src]
+
             # Skip generation of pages if we are only copying (theme public)
             if copyonly:
                 continue
@@ -59,23 +191,172 @@ class Generator:
             index = os.path.join(destpath, 'index.html')
             cindexes = [os.path.join(destpath, d, 'index.html') for d in dirs]
 
-            pages = self.pages(p[1] for p in sources)
-            children = self.pages(cindexes)
+            with span(profiler, 'listing'):
+                pages = self.pages(p[1] for p in sources)
+                children = self.pages(cindexes)
+
+                # If index not generated as part of pages, generate
+                # an index with empty content
+                if index not in [p[1] for p in sources]:
+                    sources.append((None, index))
 
-            # Remove previously generated index file to ensure it will
-            # be regenerated whether it is a page or not
-            if os.path.exists(index):
-                os.remove(index)
+                # Every page in the directory lists its siblings
+                # and children
+                listing = 'pages:%s' % destpath
+                childlisting = 'children:%s' % destpath
+                self.nodes[listing] = self.listing(pages)
+                self.nodes[childlisting] = self.listing(children)
 
-            # Generate all pages from source
+            # Generate all pages with changed dependencies
             for p in sources:
                 src, dest = p
-                self.convert(src, dest, pages, children, True)
+                inputs = [listing, childlisting, 'config', 'search']
+                if src:
+                    inputs.append('source:%s' % src)
+
+                if self.changed(dest, inputs):
+                    pending.append((src, dest, pages, children, inputs))
+                else:
+                    self.count(False)
+                    self.precompress(dest, False)
+
+        self.convert_pending(pending)
+
+    def convert_pending(self, pending):
+        """ Converts and saves pending pages, recording their dependencies.
+        Pending pages are tuples of `(source, destination, pages,
+        children, inputs)`. Conversion is spread across worker
+        processes when generating with more than one job """
 
-            # If index not generated as part of pages, generate
-            # an index with empty content
-            if not os.path.exists(index):
-                self.convert(None, index, pages, children, True)
+        search = self.search
+        jobs = min(self.jobs, len(pending))
+        if jobs > 1 and hasattr(os, 'fork'):
+            results = self.convert_parallel(pending, jobs)
+        else:
+            results = []
+            for src, dest, pages, children, _ in pending:
+                templates = []
+                document = {} if search is not None else None
+                written = self.convert(src, dest, pages, children, True,
+                                       templates, document=document)
+                results.append((templates, document, written))
+
+        for p, (templates, document, written) in zip(pending, results):
+            dest, inputs = p[1], p[4]
+            inputs.extend('template:%s' % t for t in templates)
+            self.record(dest, inputs)
+            self.count(written)
+            if document is not None:
+                search.update(self.url(dest), document)
+
+    def convert_parallel(self, pending, jobs):
+        """ Converts pending pages in a pool of forked worker processes.
+        Workers are forked after the template environment is loaded
+        and inherit the pending pages so only indexes are sent to them.
+        Returns the templates used by each page, its search
+        document and whether it was written, in order """
+
+        global _pending
+
+        # Load and compile the default template once before forking
+        self.config.content_template('default')
+
+        import multiprocessing
+        if hasattr(multiprocessing, 'get_context'):
+            context = multiprocessing.get_context('fork')
+        else:
+            context = multiprocessing
+
+        _pending = (self, pending)
+        try:
+            with span(self.config.profiler, 'pool'):
+                pool = context.Pool(jobs)
+                try:
+                    chunksize = max(1, len(pending) // (jobs * 4))
+                    results = pool.map(_convert_pending,
+                                       range(len(pending)), chunksize)
+                    pool.close()
+                except:
+                    pool.terminate()
+                    raise
+                finally:
+                    pool.join()
+        finally:
+            _pending = None
+
+        # Collect the spans recorded by the workers
+        profiler = self.config.profiler
+        if profiler is not None:
+            for _, events, _, _ in results:
+                profiler.events.extend(events)
+
+        return [(templates, document, written)
+                for templates, _, document, written in results]
+
+    def count(self, written):
+        """ Counts a file of the site as written or unchanged """
+        if written:
+            self.written += 1
+        else:
+            self.unchanged += 1
+
+    def precompress(self, dest, written=True):
+        """ Writes compressed siblings of dest if enabled by
+        `config.precompress`, otherwise removes siblings left by
+        previous builds if dest was written """
+        if self.config.precompress:
+            with span(self.config.profiler, 'precompress'):
+                compress.precompress(dest, self.config)
+        elif written:
+            compress.remove_siblings(dest)
+
+    def changed(self, dest, inputs):
+        """ Returns True if dest must be generated.
+        Compares the current values of the nodes dest depended
+        on in the previous build against the manifest. Always True
+        when generating without a manifest, for a full build or if
+        any of the inputs is a new dependency of dest. """
+
+        manifest = self.manifest
+        if manifest is None:
+            return True
+
+        dependencies = manifest.dependencies.get(dest) or []
+        if self.full or not set(inputs).issubset(dependencies):
+            manifest.seen.add(dest)
+            return True
+
+        with span(self.config.profiler, 'check'):
+            return manifest.changed(dest, self.key(dependencies))
+
+    def record(self, dest, dependencies):
+        """ Records the dependencies dest was generated from """
+        manifest = self.manifest
+        if manifest is not None:
+            dependencies = sorted(set(dependencies))
+            manifest.record(dest, self.key(dependencies), dependencies)
+
+    def key(self, dependencies):
+        """ Returns the key for the current values of dependencies """
+        return hashvalue([(n, self.node(n)) for n in dependencies])
+
+    def node(self, name):
+        """ Returns the current value of a named dependency node.
+        Sources and templates are valued by content hash. Listings
+        are valued when generating the directory that contains them. """
+
+        nodes = self.nodes
+        if name not in nodes:
+            kind, _, path = name.partition(':')
+            if kind in ('source', 'template') and os.path.isfile(path):
+                nodes[name] = self.manifest.signature(path)
+            else:
+                nodes[name] = None
+        return nodes[name]
+
+    def listing(self, pages):
+        """ Returns the value of a listing of pages as rendered """
+        return hashvalue([(p.title, p.url) for p in pages])
 
     def resource_path(self, relpath):
         """ Retrieve a path to a static resource.
@@ -104,12 +385,13 @@ class Generator:
         # Get resources from source
         return os.path.join(self.config.sourcedir, relpath)
 
-    def regenerate(self, relpath):
-        """ Regenerate requested pages given a relative path.
+    def locate(self, relpath):
+        """ Locates the source of a requested page given a relative path.
 
-        If requesting an html page, and a source file
-        exists, regenerates from source and returns
-        content. Otherwise returns None """
+        Returns a tuple of the page destination, the source directory,
+        the source file (None when generating an index with empty
+        content) and the sibling pages and child indexes.
+        Returns None if relpath is not a page that can be regenerated """
 
         # Get base name and extension
         dbase, dext = os.path.splitext(os.path.basename(relpath))
@@ -127,16 +409,44 @@ class Generator:
         # Try to regenerate from source
         config = self.config
         reldir = os.path.dirname(relpath)
-        srcdir = os.path.join(config.sourcedir, reldir)
+        srcdir = os.path.normpath(os.path.join(config.sourcedir, reldir))
         if dext != '.html' or not os.path.exists(srcdir):
             # Can only generate html from source in directories that exist
             return None
 
         destination = os.path.join(config.outputdir, relpath)
-        destdir = os.path.dirname(destination)
+        sources, pages, children = self.scan(srcdir,
+                os.path.dirname(destination))
+        source = sources.get(dbase)
+
+        # If requesting index, and index source does not exist,
+        # generate with empty content
+        if source or dbase == 'index':
+            return (destination, srcdir, source, pages, children)
+        else:
+            return None
+
+    def scan(self, srcdir, destdir):
+        """ Classifies the entries of a source directory.
 
-        source = None
-        sources = []
+        Returns the page sources by base name and the sorted pages
+        and child indexes of the directory. Listings are cached until
+        the modification time of the directory changes, so requests
+        for pages in large directories do not rescan them. Listings of
+        directories modified within the resolution of modification
+        times are not cached as they may change without changing it """
+
+        try:
+            mtime = os.path.getmtime(srcdir)
+        except OSError:
+            mtime = None
+
+        cached = self.listings.get(srcdir)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        config = self.config
+        sources = {}
         dests = []
         childdirs = []
         for src in os.listdir(srcdir):
@@ -149,39 +459,144 @@ class Generator:
             srcpath = os.path.join(srcdir, src)
 
             if config.is_page(srcpath):
-                sources.append(srcpath)
                 dests.append(os.path.join(destdir, "%s%s" % (base, '.html')))
-                if base == dbase:
-                    source = srcpath
+                sources[base] = srcpath
             elif os.path.isdir(srcpath):
                 childdirs.append(os.path.join(destdir, src, 'index.html'))
 
-        pages = self.pages(dests)
-        children = self.pages(childdirs)
-
-        if source:
-            # Convert the existing source file
-            return self.convert(source, destination, pages, children)
-        elif dbase == 'index':
-            # If requesting index, and index source does not exist,
-            # generate with empty content
-            return self.convert(None, destination, pages, children)
+        listing = (sources, self.pages(dests), self.pages(childdirs))
+        if mtime is not None and mtime < time.time() - 2:
+            self.listings[srcdir] = (mtime, listing)
         else:
+            self.listings.pop(srcdir, None)
+        return listing
+
+    def regenerate(self, relpath, stream=False):
+        """ Regenerate requested pages given a relative path.
+
+        If requesting an html page, and a source file
+        exists, regenerates from source and returns
+        content, or an iterator of chunks of content if
+        stream is True. Otherwise returns None """
+
+        located = self.locate(relpath)
+        if located is None:
             return None
 
-    def convert(self, source, destination, pages, children, save=False):
+        destination, _, source, pages, children = located
+        return self.convert(source, destination, pages, children,
+                stream=stream)
 
-        config = self.config
-        site_root = self.site_root
-        context = config.template_context(source, destination,
-                site_root, pages, children)
-        rendered = config.convert(source, **context)
+    def page_dependencies(self, relpath):
+        """ Returns the paths of the files a requested page is
+        generated from without regenerating it: the source directory,
+        the source file and all templates. Returns None if relpath
+        is not a page that can be regenerated """
 
-        if save:
-            with codecs.open(destination, mode='w', encoding='utf-8') as dst:
-                dst.write(rendered)
+        located = self.locate(relpath)
+        if located is None:
+            return None
+
+        _, srcdir, source, _, _ = located
+        paths = [srcdir]
+        if source:
+            paths.append(source)
+        paths.extend(self.config.template_files())
+        return paths
+
+    def stamp(self, paths):
+        """ Returns the mtime and size of each path, or None if
+        a path no longer exists. Used to validate pages with
+        the paths reported by page_dependencies """
+        stamp = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+                stamp.append((st.st_mtime, st.st_size))
+            except OSError:
+                stamp.append(None)
+        return stamp
+
+    def convert(self, source, destination, pages, children, save=False,
+            dependencies=None, stream=False, document=None):
+        """ Converts source into the page at destination.
+        Saved pages are streamed to the destination file, returning
+        False if its content did not change. Returns an iterator of
+        chunks of the page if stream is True, otherwise the page.
+        Paths of templates used are appended to dependencies if a
+        list is provided. The search document of the page is stored
+        in document if a dict is provided """
 
-        return rendered
+        config = self.config
+        profiler = config.profiler
+        page = span(profiler, 'page', 'page',
+                    page=destination[len(config.outputdir) + 1:])
+        with page:
+            site_root = self.site_root
+            with span(profiler, 'context'):
+                context = config.template_context(source, destination,
+                        site_root, pages, children)
+            if dependencies is not None:
+                context['dependencies'] = dependencies
+            if self.live_reload:
+                context['live_reload'] = self.live_reload
+            if self.search_url:
+                context['search'] = self.search_url
+            if document is not None:
+                context['search_document'] = document
+
+            if stream:
+                return config.stream(source, **context)
+
+            if not save:
+                return config.convert(source, **context)
+
+            chunks = config.stream(source, **context)
+            if profiler is not None:
+                # Templates render as chunks are consumed, time
+                # each chunk so rendering is timed apart from writing
+                chunks = profiler.iterate(chunks, 'render')
+            with span(profiler, 'write'):
+                written = self.write(destination, chunks)
+            self.precompress(destination, written)
+            return written
+
+    @staticmethod
+    def write(destination, chunks):
+        """ Writes the chunks of a page encoded as UTF-8 to a temporary
+        file replacing destination atomically. Destination is left
+        untouched, keeping its modification time, if the content is
+        the same. Returns True if destination was written """
+        tmp = temporary(destination)
+        sha = hashlib.sha1()
+        size = 0
+        try:
+            with open(tmp, 'wb') as dst:
+                for chunk in chunks:
+                    data = chunk.encode('utf-8')
+                    sha.update(data)
+                    size += len(data)
+                    dst.write(data)
+
+            try:
+                same = os.path.getsize(destination) == size and \
+                    hashfile(destination) == sha.hexdigest()
+            except OSError:
+                same = False
+
+            if same:
+                os.remove(tmp)
+                return False
+            replace(tmp, destination)
+            return True
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def url(self, destination):
+        """ Returns the url of the page at destination """
+        return self.config.page(self.site_root, destination).url
 
     def pages(self, dests):
         config = self.config
@@ -1,17 +1,17 @@
 #!/usr/bin/env python
 
 from mvw.config import Config
-from mvw.generator import Generator
-from mvw.server import Server
-from optparse import OptionParser
-import imp
 import os
 import shutil
 import sys
 
+# Generator, Server and the modules they depend on are imported
+# by the commands using them to keep startup of other commands fast
+
 
 def run():
     """ Entry Point for MVW """
+    from optparse import OptionParser
 
     usage = """
             %prog [serve] : Serve the wiki locally
@@ -27,6 +27,21 @@ def run():
     version = "0.0.1"
 
     opts = OptionParser(usage=usage, description=desc, version=version)
+    opts.add_option("--full", action="store_true", default=False,
+            help="regenerate the entire site, ignoring the build manifest")
+    opts.add_option("-j", "--jobs", type="int", default=None,
+            help="number of processes converting pages "
+                 "(default: number of CPUs)")
+    opts.add_option("--compress", action="store_true", default=False,
+            help="write compressed .gz (and .br) copies of generated "
+                 "text files")
+    opts.add_option("--profile", action="store_true", default=False,
+            help="print time per build phase, per converter and "
+                 "the slowest pages")
+    opts.add_option("--profile-top", type="int", default=10,
+            help="number of slowest pages to print (default: %default)")
+    opts.add_option("--trace", default=None, metavar="FILE",
+            help="write a Chrome trace of the build phases to FILE")
     (options, args) = opts.parse_args()
 
     if len(args) == 0:
@@ -41,7 +56,9 @@ def run():
     if command == "init":
         result = init(start)
     elif command == "generate":
-        result = generate(start)
+        result = generate(start, options.full, options.jobs,
+                options.compress, options.profile, options.profile_top,
+                options.trace)
     elif command == "serve":
         result = serve(start)
     elif command == "theme":
@@ -92,17 +109,44 @@ def config(start):
     return True
 
 
-def generate(start):
+def generate(start, full=False, jobs=None, compress=False, profile=False,
+        top=10, trace=None):
     """ mvw generate
     Generates the site for the current wiki.
     Searches up the directory tree for a .mvw directory
-    and generates the site into .mvw/site
+    and generates the site into .mvw/site. Only changed
+    sources are regenerated unless full is True. Pages are
+    converted using jobs processes (default number of CPUs).
+    Compressed copies of text files are written if compress
+    is True or enabled by config.precompress. If profile is True
+    a summary of the time per build phase and the top slowest
+    pages is printed. If trace is given, a Chrome trace of the
+    build phases is written to that file. Prints the number of
+    files written, unchanged and removed.
     """
-    Generator(create_config(start)).generate()
+    config = create_config(start)
+    if compress:
+        config.precompress = True
+    if profile or trace:
+        from mvw.profiler import Profiler
+        config.profiler = Profiler()
+
+    from mvw.generator import Generator
+    generator = Generator(config)
+    generator.generate(full, jobs)
+    print("Wrote %d files, %d unchanged, %d removed" % (
+        generator.written, generator.unchanged, generator.removed))
+
+    if profile:
+        print(config.profiler.report(top))
+    if trace:
+        config.profiler.write_trace(trace)
     return True
 
 
 def serve(start):
+    from mvw.generator import Generator
+    from mvw.server import Server
     config = create_config(start)
     generator = Generator(config)
     server = Server(generator, '127.0.0.1', config.port)
@@ -120,7 +164,7 @@ def create_config(start):
     else:
         mvwconfigpath = Config.expandpath('mvwconfig.py', root)
         if os.path.isfile(mvwconfigpath):
-            mvwconfig = imp.load_source('mvwconfig', mvwconfigpath)
+            mvwconfig = load_source('mvwconfig', mvwconfigpath)
             config = mvwconfig.config
 
     if config is None:
@@ -129,6 +173,22 @@ def create_config(start):
     return config.load(root, get_defaults())
 
 
+def load_source(name, path):
+    """ Loads the python source file at path as module name """
+    try:
+        from importlib.util import module_from_spec, spec_from_file_location
+    except ImportError:
+        # python 2
+        import imp
+        return imp.load_source(name, path)
+
+    spec = spec_from_file_location(name, path)
+    module = module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
 def theme(start):
     """ mvw theme
     Copies the default theme into the configured directory.
@@ -0,0 +1,130 @@
+""" Persistent build manifest for `mvw generate`.
+The manifest is stored as JSON under the mvw root (`.mvw`) and
+records the mtime, size and content hash of every source along
+with the dependency graph of every output. Each output depends
+on named nodes (`source:<path>`, `template:<path>`, listings, ...)
+and is only regenerated when the value of one of them changed."""
+
+import hashlib
+import json
+import os
+import threading
+
+# os.replace overwrites atomically on all platforms (python 3.3+)
+replace = getattr(os, 'replace', os.rename)
+
+
+def temporary(path):
+    """ Returns the path of a temporary file next to path that is
+    unique to the process and thread, so concurrent writers of path
+    do not write or replace each other's temporary file """
+    return '%s.%d.%d.tmp' % (path, os.getpid(),
+                             threading.current_thread().ident)
+
+
+def hashfile(path, blocksize=65536):
+    """ Returns the sha1 hex digest of the contents of path """
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        block = f.read(blocksize)
+        while block:
+            sha.update(block)
+            block = f.read(blocksize)
+    return sha.hexdigest()
+
+
+def hashvalue(value):
+    """ Returns the sha1 hex digest of a JSON serializable value """
+    encoded = json.dumps(value, sort_keys=True).encode('utf-8')
+    return hashlib.sha1(encoded).hexdigest()
+
+
+class Manifest:
+    """ Records source signatures and output dependencies between builds.
+
+    `sources` maps a source path to `[mtime, size, hash]`,
+    `dependencies` maps a generated path to the names of the nodes
+    it depends on and `outputs` maps a generated path to the key
+    of the node values it was generated from. Outputs that are not
+    recorded again during a build are considered stale and can
+    be pruned. """
+
+    version = 2
+
+    def __init__(self, path):
+        self.path = path
+        self.sources = {}
+        self.outputs = {}
+        self.dependencies = {}
+        self.seen = set()
+        self.signed = set()
+
+    def load(self):
+        """ Loads a previously saved manifest if it exists and
+        was written by a compatible version """
+        if not os.path.isfile(self.path):
+            return self
+
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except ValueError:
+            # Corrupt manifest, start from scratch
+            return self
+
+        if data.get('version') == self.version:
+            self.sources = data.get('sources', {})
+            self.outputs = data.get('outputs', {})
+            self.dependencies = data.get('dependencies', {})
+        return self
+
+    def save(self):
+        """ Writes the manifest, replacing the previous one atomically """
+        data = dict(version=self.version,
+                    sources=self.sources,
+                    outputs=self.outputs,
+                    dependencies=self.dependencies)
+
+        tmp = '%s.tmp' % self.path
+        with open(tmp, 'w') as f:
+            json.dump(data, f, sort_keys=True)
+        replace(tmp, self.path)
+
+    def signature(self, source):
+        """ Returns the content hash of source.
+        The file is only rehashed if its mtime or size differ
+        from the recorded values """
+        self.signed.add(source)
+        st = os.stat(source)
+        recorded = self.sources.get(source)
+        if recorded and recorded[0] == st.st_mtime \
+                and recorded[1] == st.st_size:
+            return recorded[2]
+
+        digest = hashfile(source)
+        self.sources[source] = [st.st_mtime, st.st_size, digest]
+        return digest
+
+    def changed(self, dest, key):
+        """ Returns True if dest must be regenerated for key """
+        self.seen.add(dest)
+        return self.outputs.get(dest) != key or not os.path.exists(dest)
+
+    def record(self, dest, key, dependencies):
+        """ Records that dest was generated from key
+        and depends on the named nodes in dependencies """
+        self.seen.add(dest)
+        self.outputs[dest] = key
+        self.dependencies[dest] = dependencies
+
+    def prune(self):
+        """ Forgets outputs and sources not seen during this build.
+        Returns the list of outputs that are now stale """
+        stale = [dest for dest in self.outputs if dest not in self.seen]
+        for dest in stale:
+            del self.outputs[dest]
+            self.dependencies.pop(dest, None)
+        for source in list(self.sources):
+            if source not in self.signed:
+                del self.sources[source]
+        return stale
@@ -0,0 +1,175 @@
+""" Per-phase timing of `mvw generate --profile`.
+Phases of a build (walking sources, classifying them, converting,
+rendering, writing, ...) are timed as nested spans. A summary of
+time per phase, per converter and of the slowest pages can be
+printed and all spans written as a Chrome trace (chrome://tracing,
+Perfetto). Timing hooks are context managers returned by `span`,
+which does nothing when profiling is disabled. """
+
+import os
+import threading
+import time
+
+# Monotonic clock shared by forked worker processes
+clock = getattr(time, 'perf_counter', time.time)
+
+
+class NullSpan:
+    """ A span that does not time anything """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span:
+    """ Times a block as a span of profiler """
+
+    def __init__(self, profiler, name, category, args):
+        self.profiler = profiler
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = clock()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.add(self.name, self.category, self.start, clock(),
+                          self.args)
+        return False
+
+
+def span(profiler, name, category='phase', **args):
+    """ Returns a context manager timing a block as a span named name
+    if profiler is not None, otherwise a span that does nothing """
+    if profiler is None:
+        return NULL_SPAN
+    return Span(profiler, name, category, args)
+
+
+def describe(fn):
+    """ Returns a readable name of a converter function """
+    owner = getattr(fn, '__self__', None)
+    if owner is not None:
+        return owner.__class__.__name__
+    return getattr(fn, '__name__', repr(fn))
+
+
+class Profiler:
+    """ Records timed spans as tuples of `(name, category, start,
+    duration, pid, tid, args)`. Spans of category `page` time a
+    whole page and are summarized as the slowest pages """
+
+    def __init__(self):
+        self.events = []
+        self.origin = clock()
+
+    def add(self, name, category, start, end, args=None):
+        """ Records a span from start to end """
+        self.events.append((name, category, start, end - start,
+                            os.getpid(), threading.current_thread().ident,
+                            args or {}))
+
+    def iterate(self, iterable, name, category='phase'):
+        """ Iterates iterable timing each step as a span """
+        iterator = iter(iterable)
+        while True:
+            start = clock()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(name, category, start, clock())
+                return
+            self.add(name, category, start, clock())
+            yield item
+
+    def exclusive(self):
+        """ Returns (event, self time) pairs, the self time of a span
+        excluding the time of spans nested within it """
+        threads = {}
+        for event in self.events:
+            threads.setdefault((event[4], event[5]), []).append(event)
+
+        result = []
+        for events in threads.values():
+            events.sort(key=lambda e: (e[2], -e[3]))
+            stack = []
+            for event in events:
+                while stack and event[2] >= stack[-1][0][2] + \
+                        stack[-1][0][3]:
+                    result.append(stack.pop())
+                if stack:
+                    stack[-1][1][0] -= event[3]
+                stack.append((event, [event[3]]))
+            result.extend(stack)
+        return [(event, t[0]) for event, t in result]
+
+    def report(self, top=10):
+        """ Returns a summary of time per phase, per converter
+        and of the top slowest pages """
+
+        phases = {}
+        converters = {}
+        pages = []
+        wall = 0.0
+        for event, self_time in self.exclusive():
+            name, category, _, duration, _, _, args = event
+            if category == 'build':
+                wall = max(wall, duration)
+                name = 'other'
+            elif category == 'page':
+                pages.append((duration, args.get('page')))
+            phase = phases.setdefault(name, [0.0, 0])
+            phase[0] += self_time
+            phase[1] += 1
+            if 'converter' in args:
+                converter = converters.setdefault(args['converter'],
+                                                  [0.0, 0])
+                converter[0] += self_time
+                converter[1] += 1
+
+        total = sum(p[0] for p in phases.values()) or 1.0
+        lines = ['Generated %d pages in %.3fs' % (len(pages), wall), '',
+                 '%-16s %10s %7s %8s' % ('Phase', 'Time', 'Share', 'Count')]
+        for name, (seconds, count) in sorted(phases.items(),
+                                             key=lambda p: -p[1][0]):
+            lines.append('%-16s %9.3fs %6.1f%% %8d' % (
+                name, seconds, 100 * seconds / total, count))
+
+        if converters:
+            lines.extend(['', '%-24s %10s %8s' % ('Converter', 'Time',
+                                                   'Pages')])
+            for name, (seconds, count) in sorted(converters.items(),
+                                                 key=lambda c: -c[1][0]):
+                lines.append('%-24s %9.3fs %8d' % (name, seconds, count))
+
+        if pages:
+            lines.extend(['', 'Slowest pages'])
+            pages.sort(key=lambda p: -p[0])
+            for seconds, page in pages[:top]:
+                lines.append('%9.3fs  %s' % (seconds, page))
+
+        return '\n'.join(lines)
+
+    def trace(self):
+        """ Returns the spans as Chrome trace events """
+        events = []
+        for name, category, start, duration, pid, tid, args in self.events:
+            events.append(dict(name=name, cat=category, ph='X',
+                               ts=(start - self.origin) * 1e6,
+                               dur=duration * 1e6, pid=pid, tid=tid,
+                               args=args))
+        return dict(traceEvents=events, displayTimeUnit='ms')
+
+    def write_trace(self, path):
+        """ Writes the spans as a Chrome trace JSON file """
+        import json
+        with open(path, 'w') as f:
+            json.dump(self.trace(), f)
@@ -0,0 +1,152 @@
+""" Publishing of static files for `mvw generate`.
+Static files are published to the outputdir with one of the
+strategies in `STRATEGIES`, selected by `config.publish`:
+
+    copy      copies the file in user space
+    kernel    copies within the kernel with `os.copy_file_range`
+              or `os.sendfile` if available
+    reflink   clones the file on copy on write file systems
+              (btrfs, XFS, ...), shares blocks until modified
+    hardlink  links the output to the source file, publishing
+              takes no time or space but the output must not
+              be modified in place
+
+Strategies that are not supported by the platform or file system
+fall back to `kernel`, then `copy`. Published files keep the
+modification time of their source so unchanged files are detected
+without reading them. """
+
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from mvw.manifest import hashfile, replace, temporary
+
+# ioctl cloning a file on copy on write file systems from <linux/fs.h>
+FICLONE = 0x40049409
+
+
+def current(src, dest):
+    """ Returns True if dest is already a published copy of src.
+    Files of the same size are compared by modification time and
+    then by content hash. Matching content is given the modification
+    time of src so later checks take the fast path. """
+
+    try:
+        srcstat = os.stat(src)
+        deststat = os.stat(dest)
+    except OSError:
+        return False
+
+    if srcstat.st_size != deststat.st_size:
+        return False
+    if srcstat.st_mtime == deststat.st_mtime:
+        return True
+    if hashfile(src) != hashfile(dest):
+        return False
+
+    os.utime(dest, (deststat.st_atime, srcstat.st_mtime))
+    return True
+
+
+def copy(src, tmp):
+    """ Copies src to tmp in user space """
+    shutil.copyfile(src, tmp)
+
+
+def kernel(src, tmp):
+    """ Copies src to tmp without copying through user space """
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    sendfile = getattr(os, 'sendfile', None)
+    if copy_file_range is None and sendfile is None:
+        return copy(src, tmp)
+
+    with open(src, 'rb') as fsrc:
+        with open(tmp, 'wb') as fdst:
+            infd, outfd = fsrc.fileno(), fdst.fileno()
+            remaining = os.fstat(infd).st_size
+            while remaining > 0:
+                count = min(remaining, 1 << 30)
+                try:
+                    if copy_file_range is not None:
+                        sent = copy_file_range(infd, outfd, count)
+                    else:
+                        sent = sendfile(outfd, infd, None, count)
+                except OSError:
+                    if copy_file_range is None:
+                        raise
+                    # Not supported between these file systems
+                    copy_file_range = None
+                    if sendfile is None:
+                        break
+                    continue
+                if sent == 0:
+                    break
+                remaining -= sent
+
+    if remaining > 0:
+        copy(src, tmp)
+
+
+def reflink(src, tmp):
+    """ Clones src to tmp sharing blocks on copy on write file systems """
+    if fcntl is None:
+        return kernel(src, tmp)
+
+    with open(src, 'rb') as fsrc:
+        with open(tmp, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                return
+            except (IOError, OSError):
+                pass
+    kernel(src, tmp)
+
+
+def hardlink(src, tmp):
+    """ Links tmp to src """
+    try:
+        os.link(src, tmp)
+    except (OSError, AttributeError):
+        # Across devices or not supported by the file system
+        kernel(src, tmp)
+
+
+STRATEGIES = {
+    'copy': copy,
+    'kernel': kernel,
+    'reflink': reflink,
+    'hardlink': hardlink,
+}
+
+
+def publish(src, dest, strategy='copy'):
+    """ Publishes src to dest with the named strategy unless dest
+    is already current. The file is published to a temporary file
+    next to dest and renamed so dest is never partially written.
+    Returns True if dest was published. """
+
+    if current(src, dest):
+        return False
+
+    publisher = STRATEGIES.get(strategy)
+    if publisher is None:
+        raise ValueError('Unknown publish strategy: %s' % strategy)
+
+    tmp = temporary(dest)
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    try:
+        publisher(src, tmp)
+        if not os.path.samefile(src, tmp):
+            shutil.copystat(src, tmp)
+        replace(tmp, dest)
+    except Exception:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        raise
+    return True
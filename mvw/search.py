@@ -0,0 +1,419 @@
+""" Search index of generated pages.
+Pages are tokenized into weighted terms of their title, meta data
+and text as they are converted. The index is written to the site as
+shards of an inverted index by the first two characters of terms
+(`_search/ab.json` maps each term to a flat list of page ids and
+weights) and the url and title of every page by id
+(`_search/pages.json`), loaded lazily by the search script of the
+default theme. The terms of every page are kept under the mvw root
+so only shards with terms of changed pages are written again.
+
+`mvw serve` searches a MemoryIndex of the page sources instead. """
+
+import heapq
+import json
+import math
+import os
+import re
+import threading
+import uuid
+try:
+    # Try python 3 packages
+    from html import unescape
+except ImportError:
+    # Try python 2 packages
+    from HTMLParser import HTMLParser
+    unescape = HTMLParser().unescape
+
+from mvw.manifest import replace
+
+try:
+    # python 2
+    string_types = basestring
+except NameError:
+    string_types = str
+
+TERM_RE = re.compile(r'[^\W_]+', re.UNICODE)
+TAG_RE = re.compile(r'<[^>]*>')
+SHARD_RE = re.compile(r'^[a-z0-9]{2}')
+SPACE_RE = re.compile(r'\s+', re.UNICODE)
+MIN_TERM_LENGTH = 2
+MAX_TERM_LENGTH = 32
+
+# Weights of terms by where they occur in a page
+TITLE_WEIGHT = 10
+META_WEIGHT = 3
+TEXT_WEIGHT = 1
+
+# Bytes of page sources indexed by `mvw serve`
+SOURCE_SIZE = 256 * 1024
+
+# Characters of text around matches shown in results
+SNIPPET_SIZE = 160
+
+# Characters of the text of pages kept by `mvw serve` for snippets
+SNIPPET_SOURCE_SIZE = 4 * 1024
+
+
+def terms(text):
+    """ Yields the lower case terms of text """
+    for match in TERM_RE.finditer(text):
+        term = match.group(0).lower()
+        if MIN_TERM_LENGTH <= len(term) <= MAX_TERM_LENGTH:
+            yield term
+
+
+def text_content(html):
+    """ Returns the text of html content """
+    return unescape(TAG_RE.sub(' ', html))
+
+
+def document(title, meta, content):
+    """ Returns the searchable document of a page: its title and the
+    weights of the terms of its title, meta data and html content.
+    Weights of terms of the content grow with the logarithm of their
+    count so long pages do not outrank pages with matching titles.
+    Content that is not a string (streamed content) is not indexed """
+
+    weights = {}
+
+    def add(text, weight):
+        for term in terms(text):
+            weights[term] = weights.get(term, 0) + weight
+
+    title = title or ''
+    add(title, TITLE_WEIGHT)
+    for values in (meta or {}).values():
+        for value in values:
+            add(value, META_WEIGHT)
+    if isinstance(content, string_types):
+        counts = {}
+        for term in terms(text_content(content)):
+            counts[term] = counts.get(term, 0) + 1
+        for term, count in counts.items():
+            weight = TEXT_WEIGHT * (1 + int(math.log(count, 2)))
+            weights[term] = weights.get(term, 0) + weight
+    return dict(title=title, terms=weights)
+
+
+def source_document(source, title, size=SOURCE_SIZE):
+    """ Returns the searchable document and text of the first size
+    bytes of a page source. Front matter is indexed as meta data """
+    from mvw.converters.markdownconvert import front_matter
+
+    with open(source, 'rb') as f:
+        text = f.read(size).decode('utf-8', 'replace')
+    meta, text = front_matter(text)
+    return document(title, meta, text), text
+
+
+def snippet(text, words, size=SNIPPET_SIZE):
+    """ Returns about size characters of text around the first
+    occurrence of one of words, or the start of text """
+    lower = text.lower()
+    found = [i for i in (lower.find(w) for w in words) if i >= 0]
+    first = min(found) if found else 0
+    start = max(0, first - size // 3)
+    if start > 0:
+        # Start at a word
+        space = text.find(' ', start, first)
+        if space >= 0:
+            start = space + 1
+    end = start + size
+    result = SPACE_RE.sub(' ', text[start:end]).strip()
+    if start > 0:
+        result = '...' + result
+    if end < len(text):
+        result = result + '...'
+    return result
+
+
+def shard(term):
+    """ Returns the name of the shard of term: the first two
+    characters of ASCII terms, otherwise the hex code of the
+    first character prefixed with an underscore """
+    if SHARD_RE.match(term):
+        return term[:2]
+    return '_%x' % ord(term[0])
+
+
+class SearchIndex:
+    """ Incrementally updated search index.
+
+    `documents` maps the url of each indexed page to its document and
+    `ids` to the id of the page in the shards. Ids of removed pages
+    are reused. `token` identifies the saved state: pages depend on it
+    so all pages are indexed again if the state is lost. """
+
+    version = 1
+
+    def __init__(self, path, directory):
+        self.path = path
+        self.directory = directory
+        self.documents = {}
+        self.ids = {}
+        self.token = None
+        self.previous = {}
+        self.fresh = True
+
+    def load(self):
+        """ Loads the previously saved state if it exists and was
+        written by a compatible version """
+        self.token = uuid.uuid4().hex
+        if not os.path.isfile(self.path):
+            return self
+
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except ValueError:
+            # Corrupt state, index every page again
+            return self
+
+        if data.get('version') == self.version and \
+                os.path.isdir(self.directory):
+            self.documents = data.get('documents', {})
+            self.ids = data.get('ids', {})
+            self.token = data.get('token')
+            self.fresh = False
+        return self
+
+    def fingerprint(self):
+        """ Returns the value pages depend on """
+        return self.token
+
+    def update(self, url, document):
+        """ Replaces the document of the page at url """
+        old = self.documents.get(url)
+        if old == document:
+            return
+        self.previous.setdefault(url, old)
+        self.documents[url] = document
+
+    def remove(self, url):
+        """ Removes the page at url from the index """
+        if url in self.documents:
+            self.previous.setdefault(url, self.documents.pop(url))
+
+    def save(self):
+        """ Writes the shards with terms of changed pages, the
+        pages and the state, replacing each file atomically """
+
+        if not self.previous and not self.fresh:
+            return
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        saved = dict(self.ids)
+        ids = self.ids
+        for url in self.previous:
+            if url not in self.documents:
+                ids.pop(url, None)
+        used = set(ids.values())
+        free = (i for i in range(len(self.documents) + 1) if i not in used)
+        for url in sorted(self.documents):
+            if url not in ids:
+                ids[url] = next(free)
+
+        if self.fresh:
+            self.write_all()
+        else:
+            self.write_changed(saved)
+
+        pages = [None] * (max(ids.values()) + 1 if ids else 0)
+        for url, i in ids.items():
+            pages[i] = [url, self.documents[url]['title']]
+        self.write(os.path.join(self.directory, 'pages.json'), pages)
+
+        self.write(self.path, dict(version=self.version,
+                                   token=self.token,
+                                   ids=ids,
+                                   documents=self.documents))
+        self.previous = {}
+        self.fresh = False
+
+    def write_all(self):
+        """ Writes every shard, removing shards of previous builds """
+        shards = {}
+        for url, doc in self.documents.items():
+            i = self.ids[url]
+            for term, weight in doc['terms'].items():
+                postings = shards.setdefault(shard(term), {})
+                postings.setdefault(term, []).extend((i, weight))
+
+        for name in os.listdir(self.directory):
+            base, ext = os.path.splitext(name)
+            if ext == '.json' and base != 'pages' and base not in shards:
+                os.remove(os.path.join(self.directory, name))
+
+        for name, postings in shards.items():
+            self.write(self.shard_path(name), postings)
+
+    def write_changed(self, saved):
+        """ Updates the shards with terms of changed pages.
+        saved maps urls to the ids of the saved shards """
+        changes = {}
+        for url, old in self.previous.items():
+            new = self.documents.get(url)
+            removed = set(old['terms']) if old else set()
+            added = new['terms'] if new else {}
+            if old and new:
+                # Only remove postings of terms of both documents
+                # if their weight changed
+                removed = set(t for t in removed
+                              if old['terms'][t] != added.get(t))
+                added = dict((t, w) for t, w in added.items()
+                             if old['terms'].get(t) != w)
+            for term in removed:
+                changes.setdefault(shard(term), ([], []))[0].append(
+                    (term, saved[url]))
+            for term, weight in added.items():
+                changes.setdefault(shard(term), ([], []))[1].append(
+                    (term, self.ids[url], weight))
+
+        for name, (removed, added) in changes.items():
+            path = self.shard_path(name)
+            postings = {}
+            if os.path.isfile(path):
+                with open(path) as f:
+                    postings = json.load(f)
+
+            for term, i in removed:
+                flat = postings.get(term, [])
+                kept = []
+                for j in range(0, len(flat), 2):
+                    if flat[j] != i:
+                        kept.extend(flat[j:j + 2])
+                if kept:
+                    postings[term] = kept
+                else:
+                    postings.pop(term, None)
+
+            for term, i, weight in added:
+                postings.setdefault(term, []).extend((i, weight))
+
+            if postings:
+                self.write(path, postings)
+            elif os.path.exists(path):
+                os.remove(path)
+
+    def shard_path(self, name):
+        return os.path.join(self.directory, '%s.json' % name)
+
+    @staticmethod
+    def write(path, value):
+        """ Writes value as compact JSON, replacing path atomically """
+        tmp = '%s.tmp' % path
+        with open(tmp, 'w') as f:
+            json.dump(value, f, separators=(',', ':'), sort_keys=True)
+        replace(tmp, path)
+
+
+class MemoryIndex:
+    """ In-memory inverted index of pages searched by `mvw serve`.
+
+    Postings map each term to the weight of the term by page id.
+    Terms are grouped by shard so the last term of a query matches
+    as a prefix without scanning every term. The start of the text
+    of pages is kept to show snippets. Safe to update while
+    searching """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ids = {}
+        self.pages = {}
+        self.postings = {}
+        self.shards = {}
+        self.free = []
+        self.ready = False
+
+    def __len__(self):
+        return len(self.pages)
+
+    def update(self, url, document, text=''):
+        """ Replaces the document and text of the page at url.
+        Only the first `SNIPPET_SOURCE_SIZE` characters of text
+        are kept """
+        text = text[:SNIPPET_SOURCE_SIZE]
+        with self.lock:
+            self._remove(url)
+            i = self.free.pop() if self.free else len(self.ids)
+            self.ids[url] = i
+            self.pages[i] = (url, document['title'], text,
+                             document['terms'])
+            for term, weight in document['terms'].items():
+                postings = self.postings.get(term)
+                if postings is None:
+                    postings = self.postings[term] = {}
+                    self.shards.setdefault(shard(term), set()).add(term)
+                postings[i] = weight
+
+    def remove(self, url):
+        """ Removes the page at url """
+        with self.lock:
+            self._remove(url)
+
+    def remove_prefix(self, prefix):
+        """ Removes the pages with urls starting with prefix """
+        with self.lock:
+            for url in [u for u in self.ids if u.startswith(prefix)]:
+                self._remove(url)
+
+    def _remove(self, url):
+        i = self.ids.pop(url, None)
+        if i is None:
+            return
+        for term in self.pages.pop(i)[3]:
+            postings = self.postings[term]
+            del postings[i]
+            if not postings:
+                del self.postings[term]
+                self.shards[shard(term)].discard(term)
+        self.free.append(i)
+
+    def matches(self, term, prefix):
+        """ Returns the weight by page id of pages containing term,
+        or a term starting with term if prefix is True """
+        if not prefix:
+            return self.postings.get(term, {})
+
+        found = {}
+        for t in self.shards.get(shard(term), ()):
+            if t.startswith(term):
+                for i, weight in self.postings[t].items():
+                    if weight > found.get(i, 0):
+                        found[i] = weight
+        return found
+
+    def search(self, query, limit=20):
+        """ Returns the number of pages matching all terms of query
+        and the url, title, snippet and score of the best limit
+        pages. Pages are ranked by the weights of the terms
+        scaled by their inverse document frequency """
+        words = list(terms(query))
+        if not words:
+            return 0, []
+
+        with self.lock:
+            total = len(self.pages) or 1
+            scores = None
+            for n, word in enumerate(words):
+                found = self.matches(word, n == len(words) - 1)
+                idf = math.log(1 + float(total) / (len(found) or 1))
+                if scores is None:
+                    scores = dict((i, w * idf) for i, w in found.items())
+                else:
+                    scores = dict((i, scores[i] + w * idf)
+                                  for i, w in found.items() if i in scores)
+                if not scores:
+                    return 0, []
+
+            best = heapq.nlargest(limit, scores.items(),
+                                  key=lambda s: (s[1], -s[0]))
+            results = []
+            for i, score in best:
+                url, title, text, _ = self.pages[i]
+                results.append(dict(url=url, title=title, score=score,
+                                    snippet=snippet(text, words)))
+            return len(scores), results
@@ -1,36 +1,87 @@
+import hashlib
+import json
 import os.path
+import socket
+import threading
+import time
+from calendar import timegm
+from email.utils import parsedate
 try:
     # Try python 3 packages
     from http.server import HTTPServer
     from http.server import SimpleHTTPRequestHandler
-    from urllib.parse import unquote
+    from urllib.parse import parse_qs, unquote
+    from queue import Queue, Empty
 except ImportError:
     # Try python 2 packages
     from BaseHTTPServer import HTTPServer
     from SimpleHTTPServer import SimpleHTTPRequestHandler
     from urllib import unquote
+    from urlparse import parse_qs
+    from Queue import Queue, Empty
+
+from mvw.cache import LRUCache
+from mvw.compress import SUFFIXES, Compressor, compress, compressible, \
+    encodings, negotiate
+
+# Path of the Server-Sent Events stream of live reload events
+EVENTS_PATH = '/_mvw/events'
+
+# Path of the search endpoint
+SEARCH_PATH = '/_search'
+
+# Maximum number of search results
+SEARCH_LIMIT = 100
+
+# Size of the chunks of streamed pages in characters
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class PageState:
+    """ Validators of a regenerated page or static file computed
+    from the modification times and sizes of the files it depends
+    on and the content encoding negotiated with the client """
+
+    def __init__(self, relpath, paths, stamp, encoding=None):
+        self.relpath = relpath
+        self.encoding = encoding
+        modified = [st[0] for st in stamp if st is not None]
+        self.last_modified = max(modified) if modified else None
+        digest = hashlib.sha1(repr((paths, stamp)).encode('utf-8'))
+        self.digest = digest.hexdigest()[:20]
+        if encoding:
+            self.etag = '"%s-%s"' % (self.digest, encoding)
+        else:
+            self.etag = '"%s"' % self.digest
+
+        # Pages whose files were modified within the resolution of file
+        # modification times may change without changing validators
+        self.racy = self.last_modified is None or \
+            self.last_modified >= time.time() - 2
 
 
 class RequestHandler(SimpleHTTPRequestHandler):
     """
     A SimpleHTTPRequestHandler that serves from the root
-    of the generated site and regenerates requested source files
+    of the generated site and regenerates requested source files.
+    Regenerated pages and compressible static files are sent
+    compressed if accepted by the client.
     """
     def do_GET(self):
         """Serve a GET request."""
-        content = self._regenerate(self.path)
-        if content:
-            self._send_regenerated_head(content)
-            self.wfile.write(content)
-        else:
+        path = self.path.split('?', 1)[0]
+        if path == EVENTS_PATH and self.server.watcher is not None:
+            self._send_events()
+        elif path == SEARCH_PATH and self.server.search is not None:
+            self._send_search()
+        elif not self._serve(head=False):
             SimpleHTTPRequestHandler.do_GET(self)
 
     def do_HEAD(self):
-        """Serve a HEAD request."""
-        content = self._regenerate(self.path)
-        if content:
-            self._send_regenerated_head(content)
-        else:
+        """Serve a HEAD request.
+        Answered from the page cache or validators without
+        regenerating the page """
+        if not self._serve(head=True):
             SimpleHTTPRequestHandler.do_HEAD(self)
 
     def translate_path(self, path):
@@ -38,14 +89,243 @@ class RequestHandler(SimpleHTTPRequestHandler):
         generator = self.server.generator
         return generator.resource_path(path)
 
-    def _regenerate(self, path):
-        path = self._relpath(path)
+    def log_request(self, code='-', size='-'):
+        """ Logs the request along with page cache statistics
+        for regenerated pages """
+        cache_status = getattr(self, 'cache_status', None)
+        if cache_status:
+            self.log_message('"%s" %s %s (cache %s: %s)',
+                    self.requestline, str(code), str(size),
+                    cache_status, self.server.page_cache.stats())
+        else:
+            SimpleHTTPRequestHandler.log_request(self, code, size)
+
+    def _serve(self, head):
+        """ Serves a regenerated page or compressed static file.
+        Returns False if the request should be served as is """
+        server = self.server
+        self.cache_status = None
+        page = server.page_state(self._relpath(self.path), self._encoding())
+        if page is not None:
+            if self._not_modified(page):
+                self._send_not_modified(page)
+                return True
+
+            if head:
+                content, self.cache_status = server.cached(page)
+            elif server.streamable(page):
+                chunks = server.generator.regenerate(page.relpath, True)
+                if chunks is None:
+                    return False
+                self.cache_status = 'stream'
+                self._send_chunked(page, chunks, 'text/html')
+                return True
+            else:
+                content, self.cache_status = server.regenerate(page)
+            if content or head:
+                self._send_head(page, content, 'text/html')
+                if not head:
+                    self.wfile.write(content)
+                return True
+            return False
+
+        static = self._static(self.path)
+        if static is not None:
+            if self._not_modified(static):
+                self._send_not_modified(static)
+                return True
+
+            content = self._compressed(static)
+            self._send_head(static, content, self.guess_type(static.relpath))
+            if not head:
+                self.wfile.write(content)
+            return True
+
+        return False
+
+    def _encoding(self):
+        """ Returns the content encoding negotiated with the client """
+        return negotiate(self.headers.get('Accept-Encoding'), encodings())
+
+    def _static(self, path):
+        """ Returns the PageState of the static file requested by path
+        if it is compressible and the client accepts a compressed
+        encoding, otherwise None """
+        encoding = self._encoding()
+        if encoding is None:
+            return None
+
+        path = self.translate_path(path)
+        if not os.path.isfile(path):
+            return None
+
+        stamp = self.server.generator.stamp([path])
+        if not compressible(path, stamp[0][1], self.server.generator.config):
+            return None
+        return PageState(path, [path], stamp, encoding)
+
+    def _compressed(self, static):
+        """ Returns the compressed content of a static file.
+        Uses the sibling precompressed by `mvw generate --compress`
+        in the output directory (`site/css/style.css.gz`) if it was
+        published from the current file, otherwise the file is
+        compressed and cached """
+        path = static.relpath
         generator = self.server.generator
-        content = generator.regenerate(path)
-        if content:
-            return content.encode('utf-8')
+        output = os.path.join(generator.config.outputdir,
+                              self._relpath(self.path))
+        sibling = output + SUFFIXES[static.encoding]
+        # Published files and their siblings keep the mtime of the file
+        source, published, compressed = generator.stamp(
+                [path, output, sibling])
+        if published == source and compressed is not None and \
+                compressed[0] == source[0]:
+            with open(sibling, 'rb') as f:
+                return f.read()
+
+        cache = self.server.page_cache
+        key = (path, static.encoding)
+        content = cache.get(key, lambda entry: entry[0] == static.digest)
+        if content is not None:
+            return content[1]
+
+        with open(path, 'rb') as f:
+            content = compress(f.read(), static.encoding)
+        if self.server.cacheable(static):
+            cache.put(key, (static.digest, content), len(content))
+        return content
+
+    def _not_modified(self, page):
+        """ Returns True if the request is conditional
+        and the client has the current version of page """
+        if page.racy:
+            return False
+
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match:
+            etags = [e.strip() for e in if_none_match.split(',')]
+            etags = [e[2:] if e.startswith('W/') else e for e in etags]
+            return page.etag in etags or '*' in etags
+
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since:
+            since = parsedate(if_modified_since)
+            if since is not None:
+                return int(page.last_modified) <= timegm(since)
+
+        return False
+
+    def _send_chunked(self, page, chunks, ctype):
+        """ Sends chunks of content as they are rendered using
+        chunked transfer encoding. Content is sent until the
+        connection is closed to HTTP/1.0 clients """
+        chunked = self.request_version == 'HTTP/1.1'
+        if chunked:
+            self.protocol_version = 'HTTP/1.1'
+        self.close_connection = True
+
+        self.send_response(200)
+        self.send_header("Content-type", ctype)
+        if page.encoding:
+            self.send_header("Content-Encoding", page.encoding)
+        if chunked:
+            self.send_header("Transfer-Encoding", 'chunked')
+        self.send_header("Connection", 'close')
+        self._send_validators(page)
+        self.end_headers()
+
+        compressor = Compressor(page.encoding) if page.encoding else None
+
+        def write(text, last=False):
+            data = text.encode('utf-8')
+            if compressor is not None:
+                data = compressor.compress(data)
+                if last:
+                    data += compressor.flush()
+            if data and chunked:
+                self.wfile.write(('%x\r\n' % len(data)).encode('ascii'))
+                self.wfile.write(data)
+                self.wfile.write(b'\r\n')
+            elif data:
+                self.wfile.write(data)
+
+        # Jinja renders many small chunks, send them in larger chunks
+        pending = []
+        size = 0
+        for chunk in chunks:
+            pending.append(chunk)
+            size += len(chunk)
+            if size >= STREAM_CHUNK_SIZE:
+                write(''.join(pending))
+                pending = []
+                size = 0
+        write(''.join(pending), last=True)
+        if chunked:
+            self.wfile.write(b'0\r\n\r\n')
+
+    def _send_events(self):
+        """ Streams live reload events to the client as Server-Sent
+        Events until it disconnects. Each event lists the URLs of
+        pages that changed, or `*` if every page changed. An extra
+        worker is started while streaming so long lived event
+        streams do not starve other requests """
+        server = self.server
+        listener = server.listen()
+        server.add_worker()
+        self.close_connection = True
+        try:
+            self.send_response(200)
+            self.send_header("Content-type", 'text/event-stream')
+            self.send_header("Cache-Control", 'no-cache')
+            self.end_headers()
+            self.wfile.write(b'retry: 1000\n\n')
+            self.wfile.flush()
+
+            while True:
+                try:
+                    urls = listener.get(timeout=15)
+                except Empty:
+                    # Keep the connection alive and detect disconnects
+                    self.wfile.write(b': ping\n\n')
+                    self.wfile.flush()
+                    continue
 
-        return None
+                if urls is None:
+                    break
+                event = 'event: reload\ndata: %s\n\n' % json.dumps(urls)
+                self.wfile.write(event.encode('utf-8'))
+                self.wfile.flush()
+        except (socket.error, IOError):
+            # Client disconnected
+            pass
+        finally:
+            server.unlisten(listener)
+            server.retire_worker()
+
+    def _send_search(self):
+        """ Sends the pages matching the `q` query parameter as JSON.
+        Returns at most `n` (default 20) ranked results with the url,
+        title, snippet and score of each page, the number of matching
+        pages and whether all sources have been indexed yet """
+        query = self.path.split('?', 1)[1] if '?' in self.path else ''
+        params = parse_qs(query)
+        q = params.get('q', [''])[0]
+        try:
+            limit = min(int(params.get('n', ['20'])[0]), SEARCH_LIMIT)
+        except ValueError:
+            limit = 20
+
+        index = self.server.search
+        total, results = index.search(q, limit)
+        content = json.dumps(dict(query=q, total=total, results=results,
+                                  ready=index.ready)).encode('utf-8')
+
+        self.send_response(200)
+        self.send_header("Content-type", 'application/json')
+        self.send_header("Content-Length", str(len(content)))
+        self.send_header("Cache-Control", 'no-cache')
+        self.end_headers()
+        self.wfile.write(content)
 
     def _relpath(self, path):
         """
@@ -70,20 +350,331 @@ class RequestHandler(SimpleHTTPRequestHandler):
 
         return path
 
-    def _send_regenerated_head(self, content):
-        """ Sends head for regenerated content """
+    def _send_validators(self, page):
+        """ Sends validators for page unless they are racy """
+        self.send_header("Cache-Control", 'no-cache')
+        self.send_header("Vary", 'Accept-Encoding')
+        if not page.racy:
+            self.send_header("ETag", page.etag)
+            self.send_header("Last-Modified",
+                    self.date_time_string(page.last_modified))
+
+    def _send_not_modified(self, page):
+        """ Sends head for a page the client already has """
+        self.send_response(304)
+        self._send_validators(page)
+        self.end_headers()
+
+    def _send_head(self, page, content, ctype):
+        """ Sends head for regenerated or compressed content.
+        Content-Length is omitted if content is not known """
         self.send_response(200)
-        self.send_header("Content-type", 'text/html')
-        self.send_header("Content-Length", len(content))
-        self.send_header("Last-Modified", self.date_time_string())
+        self.send_header("Content-type", ctype)
+        if page.encoding:
+            self.send_header("Content-Encoding", page.encoding)
+        if content is not None:
+            self.send_header("Content-Length", len(content))
+        self._send_validators(page)
         self.end_headers()
 
 
 class Server(HTTPServer):
     """
     An HTTPServer for MVW
+    Requests are handled concurrently by a pool of
+    `config.serve_workers` threads so a slow page does
+    not block other requests. Requests are handled one
+    at a time in the serving thread if set to 0.
+
+    If `config.serve_watch` is set, the source and theme
+    directories are watched. Changed pages are regenerated
+    into the page cache ahead of requests and open pages
+    are reloaded through Server-Sent Events.
+
+    If `config.search` is set, page sources are indexed in
+    memory by a background thread and searched at `/_search?q=`.
     """
+    request_queue_size = 64
+
     def __init__(self, generator, address, port):
+        config = generator.config
         self.generator = generator
+        self.page_cache = LRUCache(config.serve_cache_size)
+        self.workers = []
+        self.watcher = None
+        self.search = None
+        self.listeners = []
+        self.lock = threading.Lock()
         print("Starting server on %s:%s" % (address, port))
         HTTPServer.__init__(self, (address, port), RequestHandler)
+
+        self.requests = Queue()
+        for _ in range(config.serve_workers):
+            self.add_worker()
+
+        # Live reload needs worker threads to stream events
+        if config.serve_watch and self.workers:
+            from mvw.watcher import Watcher
+            self.watcher = Watcher([config.sourcedir, config.themedir],
+                    self.refresh, config.watch_debounce)
+            self.watcher.start()
+            generator.live_reload = EVENTS_PATH
+
+        if config.search:
+            from mvw.search import MemoryIndex
+            self.search = MemoryIndex()
+            indexer = threading.Thread(target=self.index_sources)
+            indexer.daemon = True
+            indexer.start()
+            generator.search_url = SEARCH_PATH
+
+    def add_worker(self):
+        """ Starts a thread handling queued requests """
+        worker = threading.Thread(target=self.process_requests)
+        worker.daemon = True
+        with self.lock:
+            self.workers.append(worker)
+        worker.start()
+
+    def retire_worker(self):
+        """ Stops one of the threads handling queued requests """
+        self.requests.put(None)
+
+    def process_request(self, request, client_address):
+        """ Queues the request for the worker threads """
+        if self.workers:
+            self.requests.put((request, client_address))
+        else:
+            HTTPServer.process_request(self, request, client_address)
+
+    def process_requests(self):
+        """ Handles queued requests until the worker is retired """
+        while True:
+            queued = self.requests.get()
+            if queued is None:
+                break
+
+            request, client_address = queued
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+        with self.lock:
+            self.workers.remove(threading.current_thread())
+
+    def server_close(self):
+        """ Closes the server and stops the watcher,
+        event streams and worker threads """
+        HTTPServer.server_close(self)
+        if self.watcher is not None:
+            self.watcher.stop()
+        self.notify(None)
+
+        with self.lock:
+            workers = list(self.workers)
+        for _ in workers:
+            self.retire_worker()
+        for worker in workers:
+            worker.join()
+
+    def page_state(self, relpath, encoding=None):
+        """ Returns the PageState of the page at relpath or
+        None if relpath is not a page that can be regenerated """
+        generator = self.generator
+        paths = generator.page_dependencies(relpath)
+        if paths is None:
+            return None
+        return PageState(relpath, paths, generator.stamp(paths), encoding)
+
+    def cacheable(self, page):
+        """ Returns True if the content of page can be cached.
+        Racy pages are only cached while the watcher will
+        report later modifications """
+        return self.watcher is not None or not page.racy
+
+    def streamable(self, page):
+        """ Returns True if page is regenerated from a source of at
+        least `config.serve_stream_size` bytes. These pages are
+        streamed to clients as they are rendered and not cached """
+        located = self.generator.locate(page.relpath)
+        if located is None or not located[2]:
+            return False
+        try:
+            size = os.path.getsize(located[2])
+        except OSError:
+            return False
+        return size >= self.generator.config.serve_stream_size
+
+    def cached(self, page):
+        """ Returns the cached content of page in the negotiated
+        encoding if still valid and the cache status. Cached pages
+        are compressed and the compressed variant cached when
+        first requested """
+        cache = self.page_cache
+        entry = cache.get(page.relpath, lambda entry: entry[0] == page.digest)
+        if entry is None:
+            return None, None
+
+        variants = entry[1]
+        content = variants.get(page.encoding)
+        if content is None:
+            content = compress(variants[None], page.encoding)
+            variants = dict(variants)
+            variants[page.encoding] = content
+            cache.put(page.relpath, (page.digest, variants),
+                      sum(len(v) for v in variants.values()))
+        return content, 'hit'
+
+    def regenerate(self, page, force=False):
+        """ Returns the regenerated page encoded as UTF-8 and
+        compressed with the negotiated encoding, and the cache status.
+        Pages are served from the page cache if none of the files the
+        page is generated from changed since, unless force is True """
+        if not force:
+            content, status = self.cached(page)
+            if content is not None:
+                return content, status
+
+        cache = self.page_cache
+        content = self.generator.regenerate(page.relpath)
+        if not content:
+            return None, None
+
+        cache.miss()
+        variants = {None: content.encode('utf-8')}
+        if page.encoding:
+            variants[page.encoding] = compress(variants[None], page.encoding)
+
+        if self.cacheable(page):
+            status = 'miss'
+            cache.put(page.relpath, (page.digest, variants),
+                      sum(len(v) for v in variants.values()))
+        else:
+            status = 'uncached'
+        return variants[page.encoding], status
+
+    def index_sources(self):
+        """ Indexes every page source for search """
+        sourcedir = self.generator.config.sourcedir
+        for root, dirs, files in os.walk(sourcedir):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            for f in files:
+                if not f.startswith('.'):
+                    self.index_source(os.path.join(root, f))
+        self.search.ready = True
+
+    def index_source(self, path):
+        """ Indexes the page source at path for search,
+        removing pages of sources that no longer exist """
+        generator = self.generator
+        config = generator.config
+        relpath = os.path.relpath(path, config.sourcedir)
+        base, _ = os.path.splitext(relpath)
+        destination = os.path.join(config.outputdir, base + '.html')
+        page = config.page(generator.site_root, destination)
+
+        if not os.path.exists(path):
+            # Removed sources or directories
+            self.search.remove(page.url)
+            self.search.remove_prefix(
+                    '/%s/' % relpath.replace(os.path.sep, '/'))
+        elif os.path.isfile(path) and config.is_page(path):
+            from mvw.search import source_document
+            try:
+                document, text = source_document(path, page.title)
+            except (IOError, OSError):
+                return
+            self.search.update(page.url, document, text)
+
+    def refresh(self, paths):
+        """ Regenerates pages affected by changed paths into the page
+        cache and notifies live reload listeners of pages that changed.
+        Changed sources are indexed again for search.
+        Called by the watcher with debounced changes """
+        config = self.generator.config
+        themedir = os.path.join(config.themedir, '')
+        sourcedir = os.path.join(config.sourcedir, '')
+        cache = self.page_cache
+
+        if self.search is not None:
+            for path in paths:
+                if path.startswith(sourcedir):
+                    self.index_source(path)
+
+        pages = [k for k in cache.keys() if not isinstance(k, tuple)]
+        if any(p.startswith(themedir) for p in paths):
+            # Templates or theme public changed, refresh everything
+            affected = set(pages)
+            changed = ['*']
+        else:
+            # Pages of changed sources and cached pages in directories
+            # with changed listings
+            affected = set()
+            for path in paths:
+                if path.startswith(sourcedir):
+                    base, _ = os.path.splitext(path[len(sourcedir):])
+                    affected.add('%s.html' % base)
+            for relpath in pages:
+                page = self.page_state(relpath)
+                entry = cache.peek(relpath)
+                if page is None or entry is None or \
+                        entry[0] != page.digest:
+                    affected.add(relpath)
+            changed = []
+
+        for relpath in sorted(affected):
+            previous = cache.peek(relpath)
+            previous = previous[1][None] if previous is not None else None
+
+            page = self.page_state(relpath)
+            if page is None:
+                cache.discard(relpath)
+                content = None
+            elif self.streamable(page):
+                # Streamed pages are not cached, reload them
+                cache.discard(relpath)
+                changed.extend(self.urls(relpath))
+                continue
+            else:
+                content, _ = self.regenerate(page, force=True)
+
+            if content != previous:
+                changed.extend(self.urls(relpath))
+
+        if changed:
+            self.notify(changed)
+
+    @staticmethod
+    def urls(relpath):
+        """ Returns the URLs a page at relpath is served at """
+        url = '/%s' % relpath.replace(os.path.sep, '/')
+        if os.path.basename(relpath) == 'index.html':
+            return [url, url[:-len('index.html')]]
+        if not os.path.splitext(relpath)[1] and url != '/':
+            # Directories are requested with or without a trailing slash
+            return [url, url + '/']
+        return [url]
+
+    def listen(self):
+        """ Registers and returns a queue receiving live reload events """
+        listener = Queue()
+        with self.lock:
+            self.listeners.append(listener)
+        return listener
+
+    def unlisten(self, listener):
+        """ Unregisters a queue receiving live reload events """
+        with self.lock:
+            if listener in self.listeners:
+                self.listeners.remove(listener)
+
+    def notify(self, urls):
+        """ Sends a live reload event to every listener.
+        Listeners stop when notified with None """
+        with self.lock:
+            listeners = list(self.listeners)
+        for listener in listeners:
+            listener.put(urls)
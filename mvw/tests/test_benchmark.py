@@ -0,0 +1,40 @@
+""" Tests for mvw.benchmark uses nose """
+import json
+import os
+import shutil
+import tempfile
+
+from mvw.benchmark import bench, wiki
+
+
+def test_wiki_deterministic():
+    shape = wiki.Shape(depth=1, fanout=2, files=5, size=512)
+    roots = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+    try:
+        created = [wiki.build(root, shape) for root in roots]
+        assert sum(len(v) for v in created[0].values()) == 15
+
+        for a, b in zip(*[sorted(c['markdown'] + c['binary'])
+                          for c in created]):
+            assert os.path.relpath(a, roots[0]) == \
+                os.path.relpath(b, roots[1])
+            with open(a, 'rb') as fa:
+                with open(b, 'rb') as fb:
+                    assert fa.read() == fb.read()
+    finally:
+        for root in roots:
+            shutil.rmtree(root)
+
+
+def test_bench_run():
+    shape = wiki.Shape(depth=1, fanout=1, files=3, size=256)
+    root = tempfile.mkdtemp()
+    try:
+        results = bench.run(root, shape, jobs=1, requests=10, clients=2)
+        json.dumps(results)
+        assert results['pages'] > 0
+        assert results['generate']['modified'] == 1
+        assert results['regenerate']['count'] == 10
+        assert results['serve']['cached']['count'] == 10
+    finally:
+        shutil.rmtree(root)
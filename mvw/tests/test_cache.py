@@ -0,0 +1,84 @@
+""" Tests for mvw.cache uses nose """
+from mvw.cache import LRUCache
+
+
+def test_lru_eviction():
+    cache = LRUCache(10)
+    cache.put('a', 'aaaa', 4)
+    cache.put('b', 'bbbb', 4)
+    assert cache.get('a') == 'aaaa'
+
+    # b is least recently used
+    cache.put('c', 'cccc', 4)
+    assert cache.get('b') is None
+    assert cache.get('a') == 'aaaa'
+    assert cache.get('c') == 'cccc'
+    assert cache.size == 8
+
+    # values larger than the cache are not stored
+    cache.put('d', 'd' * 11, 11)
+    assert cache.get('d') is None
+    assert cache.size == 8
+
+
+def test_lru_validation():
+    cache = LRUCache(10)
+    cache.put('a', 'aaaa', 4)
+    assert cache.get('a', lambda v: False) is None
+    assert cache.get('a') is None
+    assert cache.size == 0
+
+    cache.put('a', 'aaaa', 4)
+    cache.miss()
+    assert cache.get('a', lambda v: True) == 'aaaa'
+    assert cache.hits == 1
+    assert cache.misses == 1
+    assert cache.ratio() == 0.5
+
+
+def test_disk_cache_eviction():
+    import os
+    import shutil
+    import tempfile
+    from mvw.cache import DiskCache
+
+    directory = tempfile.mkdtemp()
+    try:
+        cache = DiskCache(directory, 100)
+        cache.put('aaaa', u'a' * 40)
+        cache.put('bbbb', u'b' * 40)
+        assert cache.get('aaaa') == u'a' * 40
+
+        # b is least recently used
+        os.utime(cache.path('bbbb'), (0, 0))
+        cache.put('cccc', u'c' * 40)
+        assert cache.get('bbbb') is None
+        assert cache.get('aaaa') == u'a' * 40
+        assert cache.get('cccc') == u'c' * 40
+        assert cache.size == 80
+
+        # values larger than the cache are not stored
+        cache.put('dddd', u'd' * 101)
+        assert cache.get('dddd') is None
+
+        # entries are shared with other instances
+        assert DiskCache(directory, 100).get('cccc') == u'c' * 40
+
+        # the size is scanned after writing a tenth of the capacity,
+        # counting rewritten entries and entries of other instances once
+        cache = DiskCache(directory, 1000)
+        cache.put('aaaa', u'a' * 40)
+        assert cache.size is None
+        cache.put('aaaa', u'a' * 40)
+        cache.put('aaaa', u'a' * 40)
+        assert cache.size == 80
+
+        # values that cannot be written are not cached
+        blocked = os.path.join(directory, 'file')
+        with open(blocked, 'w') as f:
+            f.write('not a directory')
+        cache = DiskCache(os.path.join(blocked, 'cache'), 100)
+        cache.put('eeee', u'e' * 40)
+        assert cache.get('eeee') is None
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,21 @@
+""" Tests for mvw.compress uses nose """
+import gzip
+import io
+from mvw.compress import compress, negotiate
+
+
+def test_negotiate():
+    assert negotiate('gzip, deflate', ['gzip']) == 'gzip'
+    assert negotiate('gzip;q=0.5, br', ['br', 'gzip']) == 'br'
+    assert negotiate('gzip, br;q=0.5', ['br', 'gzip']) == 'gzip'
+    assert negotiate('gzip;q=0', ['gzip']) is None
+    assert negotiate('*', ['gzip']) == 'gzip'
+    assert negotiate('identity', ['gzip']) is None
+    assert negotiate(None, ['gzip']) is None
+
+
+def test_compress_deterministic():
+    data = b'hello world ' * 100
+    assert compress(data, 'gzip') == compress(data, 'gzip')
+    compressed = io.BytesIO(compress(data, 'gzip'))
+    assert gzip.GzipFile(fileobj=compressed).read() == data
@@ -12,3 +12,61 @@ def test_defaults():
     assert config.port == 8000
     assert not config.converters
 
+
+def test_converter_dispatch():
+    calls = []
+
+    def predicate(source):
+        calls.append(source)
+        return source.endswith('.txt')
+
+    config = Config()
+    config.converter(None, 'markdown', extensions=['.md'])
+    config.converter(None, 'make', filenames=['Makefile'])
+    config.converter(predicate, 'text')
+    config.converter(None, 'rst', extensions=['.rst', '.txt'])
+    config.index_converters()
+
+    assert config.converter_for('a/hello.md') == 'markdown'
+    assert config.converter_for('a/Makefile') == 'make'
+    assert config.converter_for('a/notes.txt') == 'text'
+    assert config.converter_for('a/notes.rst') == 'rst'
+    assert config.converter_for('a/image.png') is None
+    assert calls == ['a/notes.txt', 'a/notes.rst', 'a/image.png']
+
+    # Classification is memoized per path
+    assert config.converter_for('a/image.png') is None
+    assert config.converter_for('a/notes.txt') == 'text'
+    assert len(calls) == 3
+
+
+def test_template_context():
+    import os
+    config = Config()
+    config.breadcrumb_home = 'Home'
+    site = os.path.join('out', 'site')
+    config.outputdir = site
+    dest = os.path.join(site, 'a', 'b', 'some_page.html')
+    dests = [os.path.join(site, 'a', 'b', 'index.html'),
+             os.path.join(site, 'a', 'b', 'other.html'), dest]
+
+    # Pages are interned and hashed by url
+    page = config.page('/', dest)
+    assert config.page('/', dest) is page
+    assert page.title == 'Some Page'
+    assert page.url == '/a/b/some_page.html'
+    assert len(set(config.pages('/', dests + dests))) == 3
+
+    context = config.template_context(None, dest, '/',
+                                      config.pages('/', dests), [])
+    assert context['title'] == 'Some Page'
+    assert [p.url for p in context['breadcrumb']] == \
+        ['/index.html', '/a/index.html', '/a/b/index.html']
+    assert [p.title for p in context['breadcrumb']] == ['Home', 'A', 'B']
+    assert [p.url for p in context['pages']] == \
+        ['/a/b/other.html', '/a/b/some_page.html']
+
+    # Breadcrumbs are shared by pages of a directory
+    other = config.breadcrumb('/', dests[1])
+    assert other == context['breadcrumb']
+    assert all(a is b for a, b in zip(other, context['breadcrumb']))
@@ -0,0 +1,105 @@
+""" Tests for mvw.converters uses nose """
+import os
+import shutil
+import tempfile
+from pygments.lexers import find_lexer_class_for_filename
+from mvw.config import Config
+from mvw.converters.pygmentsconvert import LexerIndex, PygmentsConverter, \
+    read_chunks
+from mvw.converters.markdownconvert import front_matter
+
+
+def test_lexer_index():
+    index = LexerIndex()
+    filenames = ['hello.py', 'foo.h', 'foo.c', 'Makefile', 'CMakeLists.txt',
+                 'a.tar.gz', 'image.png', 'README', 'x.md', 'nginx.conf',
+                 'script.PY', 'archive.bak', 'page.html']
+    for filename in filenames:
+        expected = find_lexer_class_for_filename(filename)
+        assert index.lexer_class(filename) is expected
+        # Cached lookups resolve the same lexer
+        assert index.lexer_class(filename) is expected
+
+
+def test_front_matter():
+    meta, text = front_matter('Title: Hello\nTags: a\n    b\n\n# Body\n')
+    assert meta == {'title': ['Hello'], 'tags': ['a', 'b']}
+    assert text == '# Body\n'
+
+    meta, text = front_matter('---\ntheme: wide\n---\nBody')
+    assert meta == {'theme': ['wide']}
+    assert text == 'Body'
+
+    meta, text = front_matter('# No meta\nBody')
+    assert meta == {}
+    assert text == '# No meta\nBody'
+
+
+def test_large_files():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        source = os.path.join(tmpdir, 'dump.py')
+        with open(source, 'w') as f:
+            for i in range(2000):
+                f.write('x_%d = "%s"\n\n' % (i, i))
+
+        config = Config()
+        config.highlight_cache = None
+        config.large_file_size = 0
+        converter = PygmentsConverter(config)
+        small = converter.fragment(source)[1]
+        config.large_file_size = 1024
+        config.large_file_preview_size = 100
+
+        # Previews highlight complete lines and link to the source
+        config.large_file_mode = 'preview'
+        preview = converter.fragment(source)[1]
+        assert 'Showing the first 99 of ' in preview
+        assert '<a href="dump.py">dump.py</a>' in preview
+        assert 'x_8' in preview and 'x_9' not in preview
+
+        # Streamed content is highlighted in chunks
+        config.large_file_mode = 'stream'
+        content = converter.fragment(source)[1]
+        assert not isinstance(content, str)
+        streamed = ''.join(content)
+        assert streamed.count('x_') == small.count('x_') == 2000
+        chunks = list(read_chunks(source, 100))
+        assert all(chunk.endswith('\n') for chunk in chunks)
+        with open(source) as f:
+            assert ''.join(chunks) == f.read()
+
+        config.large_file_mode = 'skip'
+        assert not converter.handles(source)
+        config.large_file_size = 0
+        assert converter.handles(source)
+        assert converter.fragment(source)[1] == small
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_fragment_cache():
+    from mvw.cache import DiskCache
+    tmpdir = tempfile.mkdtemp()
+    try:
+        config = Config()
+        config.root = tmpdir
+        config.highlight_cache = None
+        config.fragment_cache = DiskCache(os.path.join(tmpdir, 'cache'),
+                                          1024 * 1024)
+        converter = PygmentsConverter(config)
+
+        # Identical sources of different languages are cached apart
+        sources = []
+        for name in ('b.js', 'a.py'):
+            source = os.path.join(tmpdir, name)
+            with open(source, 'w') as f:
+                f.write('def f(x):\n    return x\n')
+            sources.append(source)
+        js, py = [config.fragment(converter.convert, s)[1]
+                  for s in sources]
+        assert '<span class="k">def</span>' in py
+        assert '<span class="k">def</span>' not in js
+        assert config.fragment(converter.convert, sources[1])[1] == py
+    finally:
+        shutil.rmtree(tmpdir)
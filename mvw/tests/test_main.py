@@ -1,4 +1,5 @@
 """ Tests for mvw.main using nose """
+import json
 import os
 import os.path
 import shutil
@@ -548,3 +549,396 @@ def test_generate_basic():
     assert not os.path.exists(page)
     assert not os.path.exists(childindex)
     assert not os.path.exists(childpage)
+
+
+def test_generate_incremental():
+    sitedir = chdir('basic')
+    mvwroot = dotmvw(sitedir)
+    gensitedir = mvwsite(sitedir)
+    manifest = os.path.join(mvwroot, 'manifest.json')
+    page = os.path.join(gensitedir, 'hello.html')
+    extra = os.path.join(sitedir, 'extra.md')
+    extrapage = os.path.join(gensitedir, 'extra.html')
+
+    assert not os.path.exists(mvwroot)
+    assert main.generate(sitedir)
+    assert os.path.exists(manifest)
+    assert os.path.exists(page)
+
+    # Unchanged sources are not regenerated
+    with open(page, 'w') as f:
+        f.write('stale')
+    assert main.generate(sitedir)
+    with open(page) as f:
+        assert f.read() == 'stale'
+
+    # Full generation ignores the manifest
+    assert main.generate(sitedir, full=True)
+    with open(page) as f:
+        assert f.read() != 'stale'
+
+    # Adding a page regenerates its siblings
+    with open(page, 'w') as f:
+        f.write('stale')
+    with open(extra, 'w') as f:
+        f.write('# Extra')
+    try:
+        assert main.generate(sitedir)
+        assert os.path.exists(extrapage)
+        with open(page) as f:
+            assert 'extra.html' in f.read()
+    finally:
+        os.remove(extra)
+
+    # Outputs of removed sources are deleted
+    assert main.generate(sitedir)
+    assert not os.path.exists(extrapage)
+    assert os.path.exists(page)
+
+    shutil.rmtree(mvwroot)
+    assert not os.path.exists(mvwroot)
+
+
+def test_generate_dependencies():
+    sitedir = chdir('basic')
+    mvwroot = dotmvw(sitedir)
+    gensitedir = mvwsite(sitedir)
+    index = os.path.join(gensitedir, 'index.html')
+    page = os.path.join(gensitedir, 'hello.html')
+    childpage = os.path.join(gensitedir, 'childdir', 'child.html')
+    newdir = os.path.join(sitedir, 'newdir')
+    newindex = os.path.join(gensitedir, 'newdir', 'index.html')
+
+    def stale(*paths):
+        for path in paths:
+            with open(path, 'w') as f:
+                f.write('stale')
+
+    def isstale(path):
+        with open(path) as f:
+            return f.read() == 'stale'
+
+    assert not os.path.exists(mvwroot)
+    assert main.generate(sitedir)
+
+    # Adding a subdirectory only changes listings of its parent
+    stale(index, page, childpage)
+    os.mkdir(newdir)
+    try:
+        assert main.generate(sitedir)
+        assert os.path.exists(newindex)
+        assert not isstale(index)
+        assert not isstale(page)
+        assert isstale(childpage)
+    finally:
+        os.rmdir(newdir)
+
+    # Changing a template regenerates every page using it
+    assert main.theme(sitedir)
+    assert main.generate(sitedir)
+    base = os.path.join(mvwtheme(sitedir), 'template', 'base.html')
+    stale(index, page, childpage)
+    with open(base, 'a') as f:
+        f.write('<!-- changed -->')
+    assert main.generate(sitedir)
+    assert not isstale(index)
+    assert not isstale(page)
+    assert not isstale(childpage)
+    assert not os.path.exists(newindex)
+
+    shutil.rmtree(mvwroot)
+    assert not os.path.exists(mvwroot)
+
+
+def test_generate_jobs():
+    sitedir = chdir('basic')
+    mvwroot = dotmvw(sitedir)
+    gensitedir = mvwsite(sitedir)
+
+    def read_site():
+        site = {}
+        for root, dirs, files in os.walk(gensitedir):
+            for f in files:
+                path = os.path.join(root, f)
+                with open(path, 'rb') as src:
+                    site[path] = src.read()
+        return site
+
+    # Sources with the same base name generate one page
+    twins = [os.path.join(sitedir, 'twin%d%s' % (i, ext))
+             for i in range(8) for ext in ('.md', '.py')]
+    try:
+        for twin in twins:
+            with open(twin, 'w') as f:
+                f.write('# %s\n' % os.path.basename(twin))
+
+        assert not os.path.exists(mvwroot)
+        assert main.generate(sitedir, jobs=1)
+        serial = read_site()
+
+        for _ in range(3):
+            assert main.generate(sitedir, full=True, jobs=4)
+            assert read_site() == serial
+    finally:
+        for twin in twins:
+            os.remove(twin)
+
+    shutil.rmtree(mvwroot)
+    assert not os.path.exists(mvwroot)
+
+
+def test_generate_compress():
+    sitedir = chdir('basic')
+    mvwroot = dotmvw(sitedir)
+    gensitedir = mvwsite(sitedir)
+    page = os.path.join(gensitedir, 'hello.html')
+    style = os.path.join(gensitedir, 'css', 'style.css')
+
+    assert not os.path.exists(mvwroot)
+    assert main.generate(sitedir)
+    assert not os.path.exists(page + '.gz')
+
+    assert main.generate(sitedir, compress=True)
+    assert os.path.exists(page + '.gz')
+    assert os.path.exists(style + '.gz')
+    assert os.path.getmtime(page + '.gz') == os.path.getmtime(page)
+
+    # Siblings of pages written without compression are removed
+    extra = os.path.join(sitedir, 'extra.md')
+    extrapage = os.path.join(gensitedir, 'extra.html')
+    try:
+        with open(extra, 'w') as f:
+            f.write('# Extra')
+        assert main.generate(sitedir, compress=True)
+        assert os.path.exists(extrapage + '.gz')
+        with open(extra, 'w') as f:
+            f.write('# Changed')
+        assert main.generate(sitedir)
+        assert not os.path.exists(extrapage + '.gz')
+        assert os.path.exists(page + '.gz')
+    finally:
+        os.remove(extra)
+
+    shutil.rmtree(mvwroot)
+    assert not os.path.exists(mvwroot)
+
+
+def test_regenerate_listing():
+    from mvw.generator import Generator
+    sitedir = chdir('basic')
+    mvwroot = dotmvw(sitedir)
+    extra = os.path.join(sitedir, 'extra.md')
+    past = os.path.getmtime(sitedir) - 60
+
+    assert not os.path.exists(mvwroot)
+    assert main.init(sitedir)
+    generator = Generator(main.create_config(sitedir))
+
+    # Listings of directories that did not change are reused
+    os.utime(sitedir, (past, past))
+    assert 'extra.html' not in generator.regenerate('hello.html')
+    listing = generator.listings[sitedir]
+    generator.regenerate('hello.html')
+    assert generator.listings[sitedir] is listing
+
+    # Listings are rescanned when the directory changes
+    with open(extra, 'w') as f:
+        f.write('# Extra')
+    try:
+        os.utime(sitedir, (past + 1, past + 1))
+        assert 'extra.html' in generator.regenerate('hello.html')
+        assert 'Extra' in generator.regenerate('extra.html')
+        assert generator.listings[sitedir] is not listing
+    finally:
+        os.remove(extra)
+
+    shutil.rmtree(mvwroot)
+    assert not os.path.exists(mvwroot)
+
+
+def test_regenerate_stream():
+    from mvw.generator import Generator
+    sitedir = chdir('basic')
+    mvwroot = dotmvw(sitedir)
+
+    assert not os.path.exists(mvwroot)
+    assert main.init(sitedir)
+    generator = Generator(main.create_config(sitedir))
+
+    for relpath in ['hello.html', 'childdir/', 'childdir/child.html']:
+        page = generator.regenerate(relpath)
+        chunks = generator.regenerate(relpath, stream=True)
+        assert ''.join(chunks) == page
+    assert generator.regenerate('missing.html', stream=True) is None
+
+    shutil.rmtree(mvwroot)
+    assert not os.path.exists(mvwroot)
+
+
+def test_generate_profile():
+    sitedir = chdir('basic')
+    mvwroot = dotmvw(sitedir)
+    trace = os.path.join(sitedir, 'trace.json')
+
+    assert not os.path.exists(mvwroot)
+    try:
+        assert main.generate(sitedir, jobs=2, profile=True, trace=trace)
+        with open(trace) as f:
+            events = json.load(f)['traceEvents']
+    finally:
+        os.remove(trace)
+
+    pages = set(e['args']['page'] for e in events if e['cat'] == 'page')
+    assert 'hello.html' in pages
+    assert os.path.join('childdir', 'child.html') in pages
+    names = set(e['name'] for e in events)
+    for phase in ['walk', 'classify', 'convert', 'render', 'write']:
+        assert phase in names
+
+    shutil.rmtree(mvwroot)
+    assert not os.path.exists(mvwroot)
+
+
+def test_generate_fragments():
+    from mvw.generator import Generator
+    sitedir = chdir('basic')
+    mvwroot = dotmvw(sitedir)
+    page = os.path.join(mvwsite(sitedir), 'hello.html')
+
+    assert not os.path.exists(mvwroot)
+    assert main.theme(sitedir)
+    config = main.create_config(sitedir)
+    Generator(config).generate(jobs=1)
+
+    # Template changes render cached fragments without converting
+    def unexpected(source, **context):
+        raise AssertionError('converted %s' % source)
+    for converter in config.fragments:
+        config.fragments[converter] = unexpected
+
+    base = os.path.join(mvwtheme(sitedir), 'template', 'base.html')
+    with open(base, 'a') as f:
+        f.write('<!-- changed -->')
+    Generator(config).generate(jobs=1)
+    with open(page) as f:
+        rendered = f.read()
+    assert '<!-- changed -->' in rendered
+    assert '<h1>Hello</h1>' in rendered
+
+    shutil.rmtree(mvwroot)
+    assert not os.path.exists(mvwroot)
+
+
+def test_generate_templates():
+    sitedir = chdir('basic')
+    mvwroot = dotmvw(sitedir)
+
+    assert not os.path.exists(mvwroot)
+    assert main.theme(sitedir)
+    assert main.generate(sitedir)
+    assert os.listdir(os.path.join(mvwroot, 'cache', 'templates'))
+
+    # Templates are memoized per theme until the template changes
+    config = main.create_config(sitedir)
+    template = config.content_template('default')
+    assert config.content_template('default') is template
+
+    default = os.path.join(mvwtheme(sitedir), 'template', 'default.html')
+    with open(default, 'w') as f:
+        f.write('<!-- changed -->{{ content }}')
+    mtime = os.path.getmtime(default) + 1
+    os.utime(default, (mtime, mtime))
+    changed = config.content_template('default')
+    assert changed is not template
+    assert changed.render(content='x') == '<!-- changed -->x'
+
+    shutil.rmtree(mvwroot)
+    assert not os.path.exists(mvwroot)
+
+
+def test_generate_search():
+    sitedir = chdir('basic')
+    mvwroot = dotmvw(sitedir)
+    searchdir = os.path.join(mvwsite(sitedir), '_search')
+
+    def read(name):
+        with open(os.path.join(searchdir, '%s.json' % name)) as f:
+            return json.load(f)
+
+    assert not os.path.exists(mvwroot)
+    assert main.generate(sitedir)
+    pages = read('pages')
+    urls = [p[0] for p in pages]
+    assert '/hello.html' in urls
+    assert '/childdir/child.html' in urls
+    hello = read('he')['hello']
+    assert urls.index('/hello.html') in hello[::2]
+    with open(os.path.join(mvwsite(sitedir), 'hello.html')) as f:
+        assert 'data-index="/_search/"' in f.read()
+
+    # Losing the search state indexes every page again
+    os.remove(os.path.join(mvwroot, 'search.json'))
+    shutil.rmtree(searchdir)
+    assert main.generate(sitedir)
+    assert sorted(p[0] for p in read('pages')) == sorted(urls)
+
+    shutil.rmtree(mvwroot)
+    assert not os.path.exists(mvwroot)
+
+
+def test_generate_previews():
+    from mvw.generator import Generator
+    sitedir = chdir('basic')
+    mvwroot = dotmvw(sitedir)
+    gensitedir = mvwsite(sitedir)
+    sources = [os.path.join(sitedir, name) for name in ('big.md', 'big.c')]
+    try:
+        for source in sources:
+            with open(source, 'w') as f:
+                f.write('# Big\n\n' + 'int big;\n' * 100)
+
+        # Only sources of previews are published with their page
+        config = main.create_config(sitedir)
+        config.large_file_size = 100
+        Generator(config).generate(jobs=1)
+        assert os.path.exists(os.path.join(gensitedir, 'big.c'))
+        assert not os.path.exists(os.path.join(gensitedir, 'big.md'))
+    finally:
+        for source in sources:
+            os.remove(source)
+
+    shutil.rmtree(mvwroot)
+    assert not os.path.exists(mvwroot)
+
+
+def test_generate_unchanged():
+    from mvw.generator import Generator
+    sitedir = chdir('basic')
+    mvwroot = dotmvw(sitedir)
+    page = os.path.join(mvwsite(sitedir), 'hello.html')
+
+    assert not os.path.exists(mvwroot)
+    assert main.init(sitedir)
+    generator = Generator(main.create_config(sitedir))
+    generator.generate(jobs=1)
+    assert generator.written > 0
+    assert generator.unchanged == generator.removed == 0
+
+    # Rendering the same content leaves files untouched
+    os.utime(page, (0, 0))
+    generator.generate(full=True, jobs=1)
+    assert generator.written == 0
+    assert os.path.getmtime(page) == 0
+    assert not [f for f in os.listdir(mvwsite(sitedir))
+                if f.endswith('.tmp')]
+
+    with open(page, 'w') as f:
+        f.write('stale')
+    generator.generate(full=True, jobs=1)
+    assert generator.written == 1
+    assert generator.unchanged > 0
+    with open(page) as f:
+        assert f.read() != 'stale'
+
+    shutil.rmtree(mvwroot)
+    assert not os.path.exists(mvwroot)
@@ -0,0 +1,86 @@
+""" Tests for mvw.publish uses nose """
+import os
+import shutil
+import tempfile
+import threading
+
+from mvw.publish import STRATEGIES, publish
+
+
+def test_publish_strategies():
+    root = tempfile.mkdtemp()
+    try:
+        src = os.path.join(root, 'image.png')
+        data = os.urandom(100000)
+        with open(src, 'wb') as f:
+            f.write(data)
+
+        for strategy in sorted(STRATEGIES):
+            dest = os.path.join(root, '%s.png' % strategy)
+            assert publish(src, dest, strategy)
+            with open(dest, 'rb') as f:
+                assert f.read() == data
+            assert os.path.getmtime(dest) == os.path.getmtime(src)
+            assert not [f for f in os.listdir(root) if f.endswith('.tmp')]
+
+            # Unchanged files are not published again
+            assert not publish(src, dest, strategy)
+    finally:
+        shutil.rmtree(root)
+
+
+def test_publish_current():
+    root = tempfile.mkdtemp()
+    try:
+        src = os.path.join(root, 'doc.pdf')
+        dest = os.path.join(root, 'published.pdf')
+        for path in (src, dest):
+            with open(path, 'wb') as f:
+                f.write(b'same')
+        os.utime(dest, (0, 0))
+
+        # Same content is only given the source modification time
+        assert not publish(src, dest)
+        assert os.path.getmtime(dest) == os.path.getmtime(src)
+
+        with open(src, 'wb') as f:
+            f.write(b'changed')
+        assert publish(src, dest)
+        with open(dest, 'rb') as f:
+            assert f.read() == b'changed'
+    finally:
+        shutil.rmtree(root)
+
+
+def test_publish_concurrent():
+    root = tempfile.mkdtemp()
+    try:
+        sources = []
+        for i, name in enumerate(('a.png', 'b.png')):
+            src = os.path.join(root, name)
+            with open(src, 'wb') as f:
+                f.write(os.urandom(1000000))
+            os.utime(src, (i, i))
+            sources.append(src)
+
+        # Writers of the same file do not replace each other's
+        # temporary files
+        dest = os.path.join(root, 'published.png')
+        errors = []
+
+        def publisher(i):
+            try:
+                for j in range(20):
+                    publish(sources[(i + j) % 2], dest)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=publisher, args=(i,))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert errors == []
+        assert sorted(os.listdir(root)) == ['a.png', 'b.png', 'published.png']
+    finally:
+        shutil.rmtree(root)
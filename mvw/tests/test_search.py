@@ -0,0 +1,87 @@
+""" Tests for mvw.search uses nose """
+import json
+import os
+import shutil
+import tempfile
+
+from mvw import search
+from mvw.search import MemoryIndex, SearchIndex
+
+
+def test_document():
+    doc = search.document('Hello World', {'tags': ['Greeting, world']},
+                          '<h1>Hello</h1><p>A &amp; b_c café</p>')
+    assert doc['title'] == 'Hello World'
+    assert doc['terms'] == {'hello': 11, 'world': 13, 'greeting': 3,
+                            'café': 1}
+    assert search.shard('hello') == 'he'
+    assert search.shard('été') == '_e9'
+
+    # Streamed content only indexes the title
+    assert search.document('Log', None, iter(['x']))['terms'] == {'log': 10}
+
+
+def test_search_index():
+    root = tempfile.mkdtemp()
+    try:
+        path = os.path.join(root, 'search.json')
+        directory = os.path.join(root, '_search')
+
+        def read(name):
+            with open(os.path.join(directory, '%s.json' % name)) as f:
+                return json.load(f)
+
+        index = SearchIndex(path, directory).load()
+        index.update('/a.html', search.document('Apple', None, 'one'))
+        index.update('/b.html', search.document('Banana', None, 'one'))
+        index.save()
+        assert read('pages') == [['/a.html', 'Apple'], ['/b.html', 'Banana']]
+        assert read('on') == {'one': [0, 1, 1, 1]}
+        assert read('ap') == {'apple': [0, 10]}
+
+        # Changes only update the shards with terms of changed pages
+        index = SearchIndex(path, directory).load()
+        token = index.fingerprint()
+        os.utime(os.path.join(directory, 'ap.json'), (0, 0))
+        index.remove('/b.html')
+        index.update('/c.html', search.document('Cherry', None, 'two'))
+        index.save()
+        assert os.path.getmtime(os.path.join(directory, 'ap.json')) == 0
+        assert not os.path.exists(os.path.join(directory, 'ba.json'))
+        assert read('pages') == [['/a.html', 'Apple'], ['/c.html', 'Cherry']]
+        assert read('on') == {'one': [0, 1]}
+        assert read('tw') == {'two': [1, 1]}
+        assert SearchIndex(path, directory).load().fingerprint() == token
+
+        # Lost shards index every page again
+        shutil.rmtree(directory)
+        assert SearchIndex(path, directory).load().fingerprint() != token
+    finally:
+        shutil.rmtree(root)
+
+
+def test_memory_index():
+    def document(title, text):
+        return search.document(title, None, text), text
+
+    index = MemoryIndex()
+    index.update('/a.html',
+                 *document('Apple', 'Red apples and green pears. ' * 20))
+    index.update('/b.html', *document('Pear', 'Pears are sweet.'))
+
+    total, results = index.search('pear')
+    assert total == 2
+    assert [r['url'] for r in results] == ['/b.html', '/a.html']
+    assert results[1]['snippet'].startswith('Red apples and green pears.')
+    assert results[1]['snippet'].endswith('...')
+
+    # All terms must match, the last one as a prefix
+    assert index.search('green pe')[0] == 1
+    assert index.search('green sweet')[0] == 0
+    assert index.search('')[0] == 0
+
+    index.update('/b.html', *document('Pear', 'Ripe.'))
+    assert index.search('sweet')[0] == 0
+    index.remove_prefix('/a')
+    assert index.search('apple')[0] == 0
+    assert len(index) == 1
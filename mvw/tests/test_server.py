@@ -0,0 +1,372 @@
+""" Tests for mvw.server uses nose """
+import gzip
+import io
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+try:
+    # Try python 3 packages
+    from http.client import HTTPConnection
+except ImportError:
+    # Try python 2 packages
+    from httplib import HTTPConnection
+
+from mvw import main
+from mvw.generator import Generator
+from mvw.server import Server
+
+
+def wiki(pages):
+    """ Returns a temporary wiki directory with pages by file name """
+    sitedir = tempfile.mkdtemp()
+    for name, text in pages.items():
+        with open(os.path.join(sitedir, name), 'w') as f:
+            f.write(text)
+    return sitedir
+
+
+def age(sitedir, seconds):
+    """ Sets the modification time of sitedir and its files to
+    seconds ago so pages are not racy """
+    past = time.time() - seconds
+    for name in os.listdir(sitedir):
+        os.utime(os.path.join(sitedir, name), (past, past))
+    os.utime(sitedir, (past, past))
+
+
+def serve(sitedir, **settings):
+    """ Starts a server of sitedir on an ephemeral port """
+    config = main.create_config(sitedir)
+    config.serve_watch = False
+    config.search = False
+    for name, value in settings.items():
+        setattr(config, name, value)
+    server = Server(Generator(config), '127.0.0.1', 0)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def stop(server):
+    server.shutdown()
+    server.server_close()
+
+
+def request(server, path, method='GET', headers=None, timeout=10):
+    """ Returns the response to a request and its body """
+    conn = HTTPConnection('127.0.0.1', server.server_address[1],
+                          timeout=timeout)
+    try:
+        conn.request(method, path, headers=headers or {})
+        response = conn.getresponse()
+        return response, response.read()
+    finally:
+        conn.close()
+
+
+def raw(server, path, version='HTTP/1.1', headers=''):
+    """ Sends a request on a socket and returns the status line,
+    headers and body read until the server closes the connection """
+    sock = socket.create_connection(('127.0.0.1', server.server_address[1]),
+                                    timeout=10)
+    try:
+        sock.sendall(('GET %s %s\r\nHost: localhost\r\n%s\r\n' %
+                      (path, version, headers)).encode('ascii'))
+        data = b''
+        while True:
+            received = sock.recv(65536)
+            if not received:
+                break
+            data += received
+    finally:
+        sock.close()
+
+    head, _, body = data.partition(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    fields = dict(line.split(': ', 1) for line in lines[1:])
+    return lines[0], fields, body
+
+
+def unchunk(body):
+    """ Returns the data of a chunked body, asserting its framing """
+    data = b''
+    while True:
+        size, _, body = body.partition(b'\r\n')
+        size = int(size, 16)
+        if size == 0:
+            assert body == b'\r\n'
+            return data
+        assert body[size:size + 2] == b'\r\n'
+        data += body[:size]
+        body = body[size + 2:]
+
+
+def ungzip(data):
+    return gzip.GzipFile(fileobj=io.BytesIO(data)).read()
+
+
+def slow(server, path):
+    """ Requests path in a thread, holding its rendering until the
+    returned event is set. Returns the event, thread and responses """
+    started = threading.Event()
+    rendered = threading.Event()
+    regenerate = server.generator.regenerate
+
+    def wait(relpath, stream=False):
+        started.set()
+        rendered.wait(10)
+        return regenerate(relpath, stream)
+    server.generator.regenerate = wait
+
+    responses = []
+    thread = threading.Thread(
+        target=lambda: responses.append(request(server, path)))
+    thread.start()
+    started.wait(10)
+    return rendered, thread, responses
+
+
+def test_workers():
+    sitedir = wiki({'hello.md': '# Hello', 'image.png': 'png'})
+    server = serve(sitedir, serve_workers=2)
+    try:
+        # Static files are served while a page is rendered
+        rendered, page, responses = slow(server, '/hello.html')
+        response, body = request(server, '/image.png', timeout=5)
+        assert response.status == 200 and body == b'png'
+        assert not responses
+
+        rendered.set()
+        page.join()
+        assert b'Hello' in responses[0][1]
+        workers = list(server.workers)
+        assert len(workers) == 2
+    finally:
+        stop(server)
+        shutil.rmtree(sitedir)
+
+    # Closing the server stops every worker
+    assert server.workers == []
+    assert not any(worker.is_alive() for worker in workers)
+
+
+def test_no_workers():
+    sitedir = wiki({'hello.md': '# Hello', 'image.png': 'png'})
+    server = serve(sitedir, serve_workers=0)
+    try:
+        # Requests are handled one at a time
+        assert server.workers == []
+        rendered, page, responses = slow(server, '/hello.html')
+        try:
+            request(server, '/image.png', timeout=0.5)
+            assert False, 'static file served while rendering'
+        except socket.timeout:
+            pass
+
+        rendered.set()
+        page.join()
+        assert b'Hello' in responses[0][1]
+        response, body = request(server, '/image.png')
+        assert body == b'png'
+    finally:
+        stop(server)
+        shutil.rmtree(sitedir)
+
+
+def test_search():
+    sitedir = wiki({'apple.md': '# Apple\n\nRed apples. ' * 1000,
+                    'pear.md': '# Pear\n\nPears and apples.'})
+    server = serve(sitedir, search=True)
+    try:
+        for _ in range(100):
+            if server.search.ready:
+                break
+            time.sleep(0.05)
+
+        response, body = request(server, '/_search?q=apple&n=1')
+        assert response.status == 200
+        assert response.getheader('Content-type') == 'application/json'
+        found = json.loads(body.decode('utf-8'))
+        assert found['query'] == 'apple'
+        assert found['total'] == 2
+        assert found['ready'] is True
+        assert len(found['results']) == 1
+        result = found['results'][0]
+        assert sorted(result) == ['score', 'snippet', 'title', 'url']
+        assert result['url'] == '/apple.html'
+
+        # Only the start of the text of pages is kept for snippets
+        text = server.search.pages[server.search.ids['/apple.html']][2]
+        assert len(text) < 5000
+
+        found = json.loads(request(server, '/_search?q=')[1].decode('utf-8'))
+        assert found['total'] == 0 and found['results'] == []
+    finally:
+        stop(server)
+        shutil.rmtree(sitedir)
+
+
+def test_conditional():
+    sitedir = wiki({'hello.md': '# Hello', 'other.md': '# Other'})
+    age(sitedir, 60)
+    server = serve(sitedir)
+    try:
+        response, body = request(server, '/hello.html')
+        assert response.status == 200
+        etag = response.getheader('ETag')
+        modified = response.getheader('Last-Modified')
+        assert etag and modified
+
+        response, body = request(server, '/hello.html',
+                                 headers={'If-None-Match': etag})
+        assert response.status == 304
+        assert body == b''
+        assert response.getheader('ETag') == etag
+
+        response, body = request(server, '/hello.html',
+                                 headers={'If-Modified-Since': modified})
+        assert response.status == 304
+        assert body == b''
+
+        # Pages changed after their validators were sent are sent again
+        source = os.path.join(sitedir, 'hello.md')
+        with open(source, 'w') as f:
+            f.write('# Changed')
+        past = time.time() - 30
+        os.utime(source, (past, past))
+        response, body = request(server, '/hello.html',
+                                 headers={'If-None-Match': etag})
+        assert response.status == 200
+        assert b'Changed' in body
+        assert response.getheader('ETag') != etag
+
+        # Pages changed within the resolution of modification times
+        # are sent without validators
+        os.utime(source, None)
+        etag = response.getheader('ETag')
+        response, body = request(server, '/hello.html',
+                                 headers={'If-None-Match': etag})
+        assert response.status == 200
+        assert response.getheader('ETag') is None
+        assert response.getheader('Last-Modified') is None
+
+        # HEAD of uncached pages does not regenerate them
+        regenerated = []
+
+        def unexpected(relpath, stream=False):
+            regenerated.append(relpath)
+        server.generator.regenerate = unexpected
+        response, body = request(server, '/other.html', 'HEAD')
+        assert response.status == 200
+        assert body == b''
+        assert response.getheader('Content-Length') is None
+        assert response.getheader('ETag')
+        assert regenerated == []
+    finally:
+        stop(server)
+        shutil.rmtree(sitedir)
+
+
+def test_stream():
+    sitedir = wiki({'big.md': '# Big\n\n' + 'Some words. ' * 20000})
+    server = serve(sitedir, serve_stream_size=0)
+    try:
+        status, fields, body = raw(server, '/big.html')
+        assert status == 'HTTP/1.1 200 OK'
+        assert fields['Transfer-Encoding'] == 'chunked'
+        assert 'Content-Length' not in fields
+        page = unchunk(body)
+        assert page.count(b'Some words.') == 20000
+        assert page.rstrip().endswith(b'</html>')
+
+        # HTTP/1.0 clients read until the connection is closed
+        status, fields, body = raw(server, '/big.html', 'HTTP/1.0')
+        assert status.endswith(' 200 OK')
+        assert 'Transfer-Encoding' not in fields
+        assert body == page
+
+        # Streamed compressed pages are the same as compressed pages
+        status, fields, body = raw(server, '/big.html',
+                                   headers='Accept-Encoding: gzip\r\n')
+        assert fields['Content-Encoding'] == 'gzip'
+        assert ungzip(unchunk(body)) == page
+
+        server.generator.config.serve_stream_size = 1024 * 1024
+        response, body = request(server, '/big.html',
+                                 headers={'Accept-Encoding': 'gzip'})
+        assert response.getheader('Transfer-Encoding') is None
+        assert response.getheader('Content-Encoding') == 'gzip'
+        assert ungzip(body) == page
+    finally:
+        stop(server)
+        shutil.rmtree(sitedir)
+
+
+def test_refresh():
+    sitedir = wiki({'a.md': '# A'})
+    os.mkdir(os.path.join(sitedir, 'sub'))
+    with open(os.path.join(sitedir, 'sub', 'a.md'), 'w') as f:
+        f.write('# Sub A')
+    server = serve(sitedir, serve_watch=True)
+    sock = socket.create_connection(('127.0.0.1', server.server_address[1]),
+                                    timeout=10)
+    try:
+        response, body = request(server, '/sub/')
+        assert b'b.html' not in body
+
+        sock.sendall(b'GET /_mvw/events HTTP/1.1\r\n\r\n')
+        events = sock.makefile('rb')
+        while events.readline() != b'retry: 1000\n':
+            pass
+        assert events.readline() == b'\n'
+
+        # Pages with changed listings are regenerated and reloaded
+        added = os.path.join(sitedir, 'sub', 'b.md')
+        with open(added, 'w') as f:
+            f.write('# Sub B')
+        server.refresh([added])
+        assert events.readline() == b'event: reload\n'
+        data = events.readline().decode('utf-8')
+        urls = json.loads(data[len('data: '):])
+        assert '/sub/' in urls and '/sub' in urls
+        assert '/sub/b.html' in urls
+        assert '/a.html' not in urls
+        assert b'b.html' in server.page_cache.peek('sub')[1][None]
+    finally:
+        sock.close()
+        stop(server)
+        shutil.rmtree(sitedir)
+
+
+def test_precompressed():
+    from mvw.compress import compress
+    sitedir = wiki({'hello.md': '# Hello'})
+    assert main.generate(sitedir, compress=True)
+    output = os.path.join(sitedir, '.mvw', 'site', 'css', 'style.css')
+    with open(output, 'rb') as f:
+        style = f.read()
+    mtime = os.path.getmtime(output)
+
+    # Siblings precompressed from the current file are sent
+    with open(output + '.gz', 'wb') as f:
+        f.write(compress(b'precompressed', 'gzip'))
+    os.utime(output + '.gz', (mtime, mtime))
+    server = serve(sitedir)
+    try:
+        headers = {'Accept-Encoding': 'gzip'}
+        response, body = request(server, '/css/style.css', headers=headers)
+        assert response.getheader('Content-Encoding') == 'gzip'
+        assert ungzip(body) == b'precompressed'
+
+        # Stale siblings are not
+        os.utime(output + '.gz', (mtime - 60, mtime - 60))
+        response, body = request(server, '/css/style.css', headers=headers)
+        assert ungzip(body) == style
+    finally:
+        stop(server)
+        shutil.rmtree(sitedir)
@@ -0,0 +1,57 @@
+""" Startup tests for mvw.main using python -X importtime """
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from unittest import SkipTest
+
+# Modules only the commands converting or serving pages should import
+HEAVY = ['jinja2', 'markdown', 'pygments', 'http.server', 'BaseHTTPServer',
+         'multiprocessing']
+
+
+def imported(code, cwd):
+    """ Returns the cumulative import time in microseconds
+    by module imported when running code """
+    if sys.version_info < (3, 7):
+        raise SkipTest('-X importtime requires python 3.7')
+
+    root = os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    env = dict(os.environ, PYTHONPATH=root)
+    proc = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', code],
+                            cwd=cwd, env=env, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    _, err = proc.communicate()
+    assert proc.returncode == 0, err
+
+    modules = {}
+    for line in err.decode('utf-8').splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _, cumulative, name = line.split('|')
+            if cumulative.strip().isdigit():
+                modules[name.strip()] = int(cumulative)
+    return modules
+
+
+def heavy(modules):
+    return [m for m in modules
+            if any(m == h or m.startswith(h + '.') for h in HEAVY)]
+
+
+def test_startup_commands():
+    sitedir = tempfile.mkdtemp()
+    try:
+        modules = imported('from mvw import main', sitedir)
+        assert 'mvw.main' in modules
+        assert heavy(modules) == []
+
+        code = ('from mvw import main; d = %r; '
+                'main.init(d); main.config(d); main.theme(d); '
+                'main.create_config(d)' % sitedir)
+        modules = imported(code, sitedir)
+        assert os.path.isdir(os.path.join(sitedir, '.mvw', 'theme'))
+        assert heavy(modules) == []
+    finally:
+        shutil.rmtree(sitedir)
@@ -0,0 +1,53 @@
+""" Tests for mvw.watcher uses nose """
+import os
+import shutil
+import tempfile
+import threading
+
+from mvw.watcher import PollingBackend, Watcher
+
+
+def test_polling_backend():
+    root = tempfile.mkdtemp()
+    try:
+        path = os.path.join(root, 'page.md')
+        watcher = PollingBackend([root], interval=0)
+        assert watcher.read(0) == set()
+
+        with open(path, 'w') as f:
+            f.write('# Page')
+        with open(os.path.join(root, '.page.md.swp'), 'w') as f:
+            f.write('ignored')
+        assert path in watcher.read(0)
+        assert watcher.read(0) == set()
+
+        os.remove(path)
+        assert path in watcher.read(0)
+    finally:
+        shutil.rmtree(root)
+
+
+def test_watcher_debounce():
+    root = tempfile.mkdtemp()
+    calls = []
+    called = threading.Event()
+
+    def callback(paths):
+        calls.append(paths)
+        called.set()
+
+    try:
+        watcher = Watcher([root], callback, debounce=0.2)
+        watcher.start()
+        for name in ['a.md', 'b.md']:
+            with open(os.path.join(root, name), 'w') as f:
+                f.write(name)
+        assert called.wait(5)
+        watcher.stop()
+        watcher.join(5)
+
+        assert len(calls) == 1
+        assert os.path.join(root, 'a.md') in calls[0]
+        assert os.path.join(root, 'b.md') in calls[0]
+    finally:
+        shutil.rmtree(root)
@@ -0,0 +1,228 @@
+""" Watches directory trees for changes.
+Uses inotify through ctypes on Linux and falls back to
+polling the trees for modification times and sizes.
+Hidden files and directories are ignored. """
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import threading
+import time
+import traceback
+
+# inotify event masks from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | \
+    IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+EVENT = struct.Struct('iIII')
+
+
+def ignored(name):
+    """ Returns True for hidden files and editor backups """
+    return name.startswith('.') or name.endswith('~')
+
+
+def walk(root):
+    """ Walks root yielding (dirpath, filenames) pruning ignored names """
+    for dirpath, dirs, files in os.walk(root):
+        dirs[:] = [d for d in dirs if not ignored(d)]
+        yield dirpath, [f for f in files if not ignored(f)]
+
+
+class InotifyBackend:
+    """ Reports changed paths using Linux inotify through ctypes """
+
+    def __init__(self, roots):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        self.roots = roots
+        self.watches = {}
+        try:
+            for root in roots:
+                self.watch_tree(root)
+        except OSError:
+            self.close()
+            raise
+
+    def watch(self, path):
+        """ Adds a watch for the directory at path """
+        encoded = path.encode(sys.getfilesystemencoding())
+        wd = self.libc.inotify_add_watch(self.fd, encoded, WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                return
+            raise OSError(err, 'inotify_add_watch failed: %s' % path)
+        self.watches[wd] = path
+
+    def watch_tree(self, root):
+        """ Watches root and its subdirectories.
+        Returns the files found in the tree """
+        found = []
+        for dirpath, files in walk(root):
+            self.watch(dirpath)
+            found.extend(os.path.join(dirpath, f) for f in files)
+        return found
+
+    def read(self, timeout):
+        """ Returns the set of paths changed within timeout seconds """
+        changed = set()
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return changed
+
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return changed
+            raise
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, report everything as changed
+                changed.update(self.roots)
+                continue
+
+            directory = self.watches.get(wd)
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if directory is None:
+                continue
+
+            name = name.decode(sys.getfilesystemencoding())
+            if not name:
+                changed.add(directory)
+                continue
+            if ignored(name):
+                continue
+
+            path = os.path.join(directory, name)
+            changed.add(path)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                # Files may be created before the directory is watched
+                changed.update(self.watch_tree(path))
+
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingBackend:
+    """ Reports changed paths by periodically comparing the
+    modification times and sizes of all files in the trees """
+
+    def __init__(self, roots, interval=1.0):
+        self.roots = roots
+        self.interval = interval
+        self.snapshot = self.scan()
+
+    def scan(self):
+        """ Returns the mtime and size of every file and directory """
+        snapshot = {}
+        for root in self.roots:
+            for dirpath, files in walk(root):
+                for path in [dirpath] + [os.path.join(dirpath, f)
+                                         for f in files]:
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    snapshot[path] = (st.st_mtime, st.st_size)
+        return snapshot
+
+    def read(self, timeout):
+        """ Returns the set of paths changed since the last scan.
+        Scans at most once every interval seconds """
+        time.sleep(min(timeout, self.interval))
+        snapshot = self.scan()
+        previous = self.snapshot
+        self.snapshot = snapshot
+
+        changed = set(p for p, st in snapshot.items()
+                      if previous.get(p) != st)
+        changed.update(p for p in previous if p not in snapshot)
+        return changed
+
+    def close(self):
+        pass
+
+
+def backend(roots):
+    """ Returns the best available backend watching roots """
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyBackend(roots)
+        except (OSError, AttributeError):
+            # No inotify or out of watches, fall back to polling
+            pass
+    return PollingBackend(roots)
+
+
+class Watcher(threading.Thread):
+    """ Watches directory trees in a daemon thread and calls
+    `callback(paths)` with the set of changed paths. Changes are
+    debounced: paths are collected until no changes are seen for
+    `debounce` seconds so a burst of saves results in one call. """
+
+    def __init__(self, roots, callback, debounce=0.25):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.roots = [r for r in roots if os.path.isdir(r)]
+        self.callback = callback
+        self.debounce = debounce
+        self.stopped = threading.Event()
+        self.backend = backend(self.roots)
+
+    def run(self):
+        pending = set()
+        try:
+            while not self.stopped.is_set():
+                timeout = self.debounce if pending else 1.0
+                changed = self.backend.read(timeout)
+                if changed:
+                    pending.update(changed)
+                elif pending:
+                    paths, pending = pending, set()
+                    try:
+                        self.callback(paths)
+                    except Exception:
+                        traceback.print_exc()
+        finally:
+            self.backend.close()
+
+    def stop(self):
+        """ Stops watching after the current wait """
+        self.stopped.set()